@@ -1,9 +1,13 @@
 from flask import Flask
 
-def create_app():
+def create_app(start_refresher=True):
     app = Flask(__name__)
 
     from .routes import bp
     app.register_blueprint(bp)
 
+    if start_refresher:
+        from . import refresher
+        refresher.start()
+
     return app
\ No newline at end of file
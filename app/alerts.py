@@ -1,17 +1,24 @@
+import hashlib
+import math
 import os
+import random
 import time
-from datetime import datetime, timedelta
+from bisect import bisect_right
+from typing import NamedTuple, Optional
 
-import requests
 from nyct_gtfs.compiled_gtfs import gtfs_realtime_pb2
 
+from app import http_client, metrics
+from app.breaker import CircuitOpenError
+from app.config import ALL_LINE_IDS
+from app.helpers.keyword_matcher import KeywordMatcher, load_keywords
+from app.http_client import NOT_MODIFIED
+
 DEFAULT_ALERTS_URL = "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/camsys%2Fsubway-alerts"
 
 ALERTS_TTL_S = int(os.getenv("ALERTS_TTL_S", "120"))
 MTA_ALERTS_URL = os.getenv("MTA_ALERTS_URL", DEFAULT_ALERTS_URL)
-
-LAST_ALERTS_REFRESH = datetime.min
-CACHED_ALERTS = None
+ALERTS_RETRY_DELAY_S = float(os.getenv("ALERTS_RETRY_DELAY_S", "0.5"))
 
 DELAY_KEYWORDS = (
     "delay",
@@ -22,18 +29,26 @@ DELAY_KEYWORDS = (
     "slow",
     "medical emergency",
     "police activity",
+    "running late",
+    "stalled",
+    "holding",
 )
 CHANGE_KEYWORDS = (
     "service change",
     "reroute",
     "rerouted",
+    "re-route",
     "bypass",
     "bypassing",
     "skip",
     "skipping",
     "expressed",
     "detour",
+    "diverted",
     "shuttle",
+    "terminating",
+    "terminate",
+    "turning",
 )
 PLANNED_KEYWORDS = (
     "planned work",
@@ -41,8 +56,18 @@ PLANNED_KEYWORDS = (
     "construction",
     "track work",
     "scheduled",
+    "signal modernization",
+    "weekend work",
+    "capital work",
 )
 
+KEYWORDS = load_keywords({
+    "DLY": DELAY_KEYWORDS,
+    "CHG": CHANGE_KEYWORDS,
+    "PLN": PLANNED_KEYWORDS,
+})
+KEYWORD_MATCHER = KeywordMatcher(KEYWORDS)
+
 BADGE_PRIORITY = {
     "OT": 0,
     "PLN": 1,
@@ -50,39 +75,36 @@ BADGE_PRIORITY = {
     "DLY": 3,
 }
 
-LINE_IDS = {"Q", "6"}
-
 def fetch_alerts_feed(url):
+    """Fetch and parse the alerts feed, or return NOT_MODIFIED on a 304."""
     last_error = None
     for attempt in range(2):
+        if attempt:
+            # Jittered so replicas that failed together do not retry together.
+            time.sleep(random.uniform(0, ALERTS_RETRY_DELAY_S))
+            metrics.inc("mta_upstream_retries_total", source="alerts")
         try:
-            response = requests.get(url, timeout=4)
-            response.raise_for_status()
+            with metrics.timed("fetch", source="alerts"):
+                content = http_client.fetch(url, timeout=4)
+            if content is NOT_MODIFIED:
+                return NOT_MODIFIED
+            metrics.set_gauge("mta_feed_bytes", len(content), source="alerts")
             feed = gtfs_realtime_pb2.FeedMessage()
-            feed.ParseFromString(response.content)
+            try:
+                with metrics.timed("parse", source="alerts"):
+                    feed.ParseFromString(content)
+            except Exception:
+                http_client.invalidate(url)
+                raise
             return feed
+        except CircuitOpenError:
+            # The endpoint is known to be failing; retrying now only adds latency.
+            raise
         except Exception as exc:
+            metrics.inc("mta_upstream_errors_total", source="alerts")
             last_error = exc
-            if attempt == 0:
-                time.sleep(0.5)
     raise last_error
 
-def get_alerts_feed(now):
-    global LAST_ALERTS_REFRESH, CACHED_ALERTS
-
-    if now - LAST_ALERTS_REFRESH < timedelta(seconds=ALERTS_TTL_S):
-        return CACHED_ALERTS
-
-    try:
-        feed = fetch_alerts_feed(MTA_ALERTS_URL)
-        CACHED_ALERTS = feed
-    except Exception:
-        feed = None
-    finally:
-        LAST_ALERTS_REFRESH = now
-
-    return CACHED_ALERTS if feed is None else feed
-
 def _extract_translated_text(translated):
     if not translated or not translated.translation:
         return ""
@@ -145,21 +167,18 @@ def _classify_by_cause_effect(alert):
     return None
 
 def _classify_alert(alert):
-    text = _alert_text_combined(alert)
-    lower = text.lower()
-    matched_text = False
+    found = KEYWORD_MATCHER.find(_alert_text_combined(alert))
+    matched_text = True
 
-    if any(keyword in lower for keyword in DELAY_KEYWORDS):
+    if "DLY" in found:
         badge = "DLY"
-        matched_text = True
-    elif any(keyword in lower for keyword in CHANGE_KEYWORDS):
+    elif "CHG" in found:
         badge = "CHG"
-        matched_text = True
-    elif any(keyword in lower for keyword in PLANNED_KEYWORDS):
+    elif "PLN" in found:
         badge = "PLN"
-        matched_text = True
     else:
         badge = _classify_by_cause_effect(alert)
+        matched_text = False
 
     reason = None
     if badge and matched_text:
@@ -167,56 +186,317 @@ def _classify_alert(alert):
 
     return badge, reason
 
-def _affected_lines(alert):
+# An alert without active_period is active for as long as it is in the feed.
+ALWAYS_ACTIVE = ((-math.inf, math.inf),)
+
+def _active_ranges(alert):
+    """Return the alert's active periods as [start, end) epoch pairs."""
+    if not alert.active_period:
+        return ALWAYS_ACTIVE
+    return tuple(
+        (period.start or -math.inf, period.end or math.inf) for period in alert.active_period
+    )
+
+def _is_active(ranges, now_ts):
+    return any(start <= now_ts < end for start, end in ranges)
+
+def _affected_lines(alert, line_ids):
     lines = set()
     for entity in alert.informed_entity:
-        if entity.route_id in LINE_IDS:
+        if entity.route_id in line_ids:
             lines.add(entity.route_id)
     return lines
 
-def compute_status_from_alerts(feed):
-    if feed is None:
-        return {
-            "Q": {"badge": "UNK"},
-            "6": {"badge": "UNK"},
-        }
-
-    status = {
-        "Q": {"badge": "OT"},
-        "6": {"badge": "OT"},
+TRIP_DELAY_REASON = "Delay reported in trip updates"
+
+def delayed_lines(trips):
+    """Return the routes with at least one trip flagged as delayed in the trip feed."""
+    lines = set()
+    for trip in trips:
+        if getattr(trip, "has_delay_alert", False):
+            lines.add(trip.route_id)
+    return frozenset(lines)
+
+def status_from_trip_delays(delayed, lines=None):
+    """Fallback status while the alerts feed is unavailable.
+
+    Lines with delayed trips are DLY; nothing is known about the others.
+    """
+    if lines is None:
+        lines = ALL_LINE_IDS
+    return {
+        line: {"badge": "DLY", "reason": TRIP_DELAY_REASON} if line in delayed else {"badge": "UNK"}
+        for line in lines
     }
-    reasons = {"Q": None, "6": None}
-    priorities = {"Q": 0, "6": 0}
 
+def _fold_line_status(classifications):
+    """Reduce (badge, reason) pairs, in feed order, to one line's status."""
+    entry = {"badge": "OT"}
+    priority = 0
+    line_reason = None
+    for badge, reason in classifications:
+        badge_priority = BADGE_PRIORITY.get(badge, 0)
+        if badge_priority > priority:
+            entry["badge"] = badge
+            priority = badge_priority
+            line_reason = reason
+        elif badge_priority == priority and reason and not line_reason:
+            line_reason = reason
+    if line_reason:
+        entry["reason"] = line_reason
+    return entry
+
+def compute_status_from_alerts(feed, lines=None, delayed=frozenset(), now=None):
+    """Badge every line (default: every route) from the alerts active at now.
+
+    One pass over the alerts feed; now is an epoch and defaults to the
+    current time.
+    """
+    if lines is None:
+        lines = ALL_LINE_IDS
+
+    if feed is None:
+        return status_from_trip_delays(delayed, lines)
+
+    now_ts = time.time() if now is None else now
+    by_line = {line: [] for line in lines}
     for entity in feed.entity:
         if not entity.HasField("alert"):
             continue
         alert = entity.alert
-        lines = _affected_lines(alert)
-        if not lines:
+        affected = _affected_lines(alert, by_line)
+        if not affected or not _is_active(_active_ranges(alert), now_ts):
             continue
 
         badge, reason = _classify_alert(alert)
         if not badge:
             continue
+        for line in affected:
+            by_line[line].append((badge, reason))
+
+    return {line: _fold_line_status(classifications) for line, classifications in by_line.items()}
+
+class StatusTimeline:
+    """Per-line status for each interval between alert period boundaries.
+
+    statuses[i] holds from boundaries[i - 1] (inclusive) until boundaries[i];
+    statuses[0] has no lower bound and the last one no upper bound. Entries
+    are shared, never mutated.
+    """
+
+    __slots__ = ("boundaries", "statuses")
+
+    def __init__(self, boundaries, statuses):
+        self.boundaries = tuple(boundaries)
+        self.statuses = tuple(statuses)
+
+    @classmethod
+    def constant(cls, status):
+        return cls((), (status,))
+
+    def at(self, now_ts):
+        return self.statuses[bisect_right(self.boundaries, now_ts)]
+
+    def next_change(self, now_ts):
+        """Return the first boundary after now_ts, or inf if the status never changes."""
+        index = bisect_right(self.boundaries, now_ts)
+        return self.boundaries[index] if index < len(self.boundaries) else math.inf
+
+    def map(self, fn):
+        return StatusTimeline(self.boundaries, [fn(status) for status in self.statuses])
+
+def build_status_timeline(alerts, lines):
+    """Sweep the active periods of classified alerts into a StatusTimeline.
+
+    alerts are (position, lines, badge, reason, ranges) tuples with distinct
+    positions. Only lines touched by an alert starting or ending at a
+    boundary are re-folded there, and boundaries where no line's status
+    changes are dropped.
+    """
+    by_position = {}
+    events = {}
+    counts = {}
+    for alert in alerts:
+        position, _, _, _, ranges = alert
+        by_position[position] = alert
+        for start, end in ranges:
+            if start >= end:
+                continue
+            if start == -math.inf:
+                counts[position] = counts.get(position, 0) + 1
+            else:
+                events.setdefault(start, []).append((position, 1))
+            if end != math.inf:
+                events.setdefault(end, []).append((position, -1))
+
+    # Active positions per line and badge priority, and the subset of them
+    # with a reason, so folding a line is a max and a min rather than a pass
+    # over every active alert.
+    active = {line: {} for line in lines}
+    reasoned = {line: {} for line in lines}
+
+    def toggle(position, on):
+        _, affected, badge, reason, _ = by_position[position]
         priority = BADGE_PRIORITY.get(badge, 0)
-
+        for line in affected:
+            for sets in (active, reasoned) if reason else (active,):
+                positions = sets[line].setdefault(priority, set())
+                if on:
+                    positions.add(position)
+                else:
+                    positions.discard(position)
+
+    def fold(line):
+        # Same result as _fold_line_status over the active alerts in feed order.
+        priority = max((priority for priority, positions in active[line].items() if positions), default=0)
+        positions = active[line].get(priority)
+        entry = {"badge": by_position[min(positions)][2] if priority else "OT"}
+        with_reason = reasoned[line].get(priority)
+        if with_reason:
+            entry["reason"] = by_position[min(with_reason)][3]
+        return entry
+
+    for position in counts:
+        toggle(position, True)
+
+    status = {line: fold(line) for line in lines}
+    boundaries = []
+    statuses = [status]
+    for boundary in sorted(events):
+        dirty = set()
+        for position, delta in events[boundary]:
+            before = counts.get(position, 0)
+            counts[position] = before + delta
+            if (before > 0) == (before + delta > 0):
+                continue
+            toggle(position, before + delta > 0)
+            dirty.update(by_position[position][1])
+        changed = {line: fold(line) for line in dirty}
+        changed = {line: entry for line, entry in changed.items() if entry != status[line]}
+        if not changed:
+            continue
+        status = {**status, **changed}
+        boundaries.append(boundary)
+        statuses.append(status)
+    return StatusTimeline(boundaries, statuses)
+
+class _CachedAlert(NamedTuple):
+    digest: bytes
+    position: int
+    lines: frozenset
+    badge: Optional[str]
+    reason: Optional[str]
+    ranges: tuple
+
+class AlertStatusCache:
+    """Per-line status timeline that only re-classifies new or changed alerts.
+
+    Classifications are cached by entity id plus a hash of the alert's
+    content and evicted once the entity disappears from the feed. Each
+    line keeps its own list of status changes, and only the lines of an
+    alert that was added, changed or evicted are swept again; the other
+    lines' changes are merged in as they are. Reordering unchanged alerts
+    can change which one wins a tie, so it re-sweeps every line.
+    """
+
+    def __init__(self, lines=None):
+        self.lines = tuple(ALL_LINE_IDS if lines is None else lines)
+        self._line_set = frozenset(self.lines)
+        self._entries = {}
+        # line -> (status before the first boundary, ((boundary, status), ...))
+        self._line_changes = {}
+        self._timeline = None
+        self.classified = 0
+        self.evicted = 0
+        self.rebuilt_lines = 0
+
+    def update(self, feed, delayed=frozenset(), now=None):
+        """Return the status at now (default: the current time) after reading feed."""
+        if feed is None:
+            return status_from_trip_delays(delayed, self.lines)
+        return self.update_timeline(feed).at(time.time() if now is None else now)
+
+    def update_timeline(self, feed):
+        self.classified = 0
+        self.evicted = 0
+        seen = set()
+        dirty = set(self.lines) if self._timeline is None else set()
+        reordered = False
+        last_position = -1
+
+        for position, entity in enumerate(feed.entity):
+            if not entity.HasField("alert"):
+                continue
+            entity_id = entity.id
+            if not entity_id or entity_id in seen:
+                entity_id = f"{entity.id}#{position}"
+            seen.add(entity_id)
+
+            digest = hashlib.blake2b(
+                entity.alert.SerializeToString(deterministic=True), digest_size=16
+            ).digest()
+            cached = self._entries.get(entity_id)
+            if cached is not None and cached.digest == digest:
+                # Unchanged alerts must keep their relative order for the
+                # per-line tie-breaks to still hold.
+                reordered = reordered or cached.position < last_position
+                last_position = cached.position
+                if cached.position != position:
+                    self._entries[entity_id] = cached._replace(position=position)
+                continue
+
+            alert = entity.alert
+            affected = frozenset(_affected_lines(alert, self._line_set))
+            badge, reason = _classify_alert(alert) if affected else (None, None)
+            self.classified += 1
+            if not badge:
+                affected = frozenset()
+            if cached is not None:
+                dirty.update(cached.lines)
+            dirty.update(affected)
+            self._entries[entity_id] = _CachedAlert(
+                digest, position, affected, badge, reason, _active_ranges(alert)
+            )
+
+        for entity_id in [entity_id for entity_id in self._entries if entity_id not in seen]:
+            dirty.update(self._entries.pop(entity_id).lines)
+            self.evicted += 1
+
+        if reordered:
+            dirty = set(self.lines)
+        self.rebuilt_lines = len(dirty)
+        if dirty:
+            self._sweep_lines(dirty)
+        return self._timeline
+
+    def _sweep_lines(self, dirty):
+        lines = tuple(line for line in self.lines if line in dirty)
+        swept = build_status_timeline(
+            (
+                (cached.position, cached.lines & dirty, cached.badge, cached.reason, cached.ranges)
+                for cached in self._entries.values()
+                if not cached.lines.isdisjoint(dirty)
+            ),
+            lines,
+        )
         for line in lines:
-            if priority > priorities[line]:
-                status[line]["badge"] = badge
-                priorities[line] = priority
-                reasons[line] = reason
-            elif priority == priorities[line] and reason and not reasons[line]:
-                reasons[line] = reason
-
-    for line, reason in reasons.items():
-        if reason:
-            status[line]["reason"] = reason
-
-    return status
-
-def get_alerts_status(now=None):
-    if now is None:
-        now = datetime.now()
-    feed = get_alerts_feed(now)
-    return compute_status_from_alerts(feed)
+            previous = swept.statuses[0][line]
+            changes = []
+            for boundary, status in zip(swept.boundaries, swept.statuses[1:]):
+                if status[line] is not previous:
+                    previous = status[line]
+                    changes.append((boundary, previous))
+            self._line_changes[line] = (swept.statuses[0][line], tuple(changes))
+
+        by_boundary = {}
+        for line, (_, changes) in self._line_changes.items():
+            for boundary, entry in changes:
+                by_boundary.setdefault(boundary, {})[line] = entry
+        status = {line: self._line_changes[line][0] for line in self.lines}
+        boundaries = []
+        statuses = [status]
+        for boundary in sorted(by_boundary):
+            status = {**status, **by_boundary[boundary]}
+            boundaries.append(boundary)
+            statuses.append(status)
+        self._timeline = StatusTimeline(boundaries, statuses)
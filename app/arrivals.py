@@ -0,0 +1,132 @@
+# Per-stop arrival index built once per trip feed refresh.
+#
+# The index maps (stop_id, route_id) -> StopArrivals, with arrivals sorted
+# by time so a board is a dictionary lookup plus a bisect on "now". Lines
+# sharing a platform (N/Q/R/W at Times Sq) get separate entries, so each
+# board lists only its own line. Each arrival also
+# carries its JSON encoding up to the minutes_until value, so encoding a
+# board only formats the minutes and joins bytes.
+#
+# Between refreshes only "now" moves: window_expiry() gives the instant a
+# board next changes, so callers can reuse an encoded board until then.
+import json
+import math
+from array import array
+from bisect import bisect_right
+
+EMPTY_WINDOW = (0, ())
+
+
+def _arrival_prefix(destination, direction):
+    return (
+        b'{"destination": ' + json.dumps(destination).encode("utf-8")
+        + b', "direction": ' + json.dumps(direction).encode("utf-8")
+        + b', "minutes_until": '
+    )
+
+
+class StopArrivals:
+    """Arrivals at one stop, sorted by time.
+
+    epochs is an array of arrival timestamps; trains and fragments are
+    parallel tuples of (destination, direction) and the encoded prefix of
+    each arrival. Equal trains share one tuple and one fragment.
+    """
+
+    __slots__ = ("epochs", "trains", "fragments")
+
+    def __init__(self, epochs, trains, fragments=None):
+        self.epochs = array("d", epochs)
+        self.trains = tuple(trains)
+        if fragments is None:
+            fragments = [_arrival_prefix(destination, direction) for destination, direction in self.trains]
+        self.fragments = tuple(fragments)
+
+    def __eq__(self, other):
+        if not isinstance(other, StopArrivals):
+            return NotImplemented
+        return self.epochs == other.epochs and self.trains == other.trains
+
+    def __repr__(self):
+        return f"StopArrivals(epochs={list(self.epochs)!r}, trains={self.trains!r})"
+
+
+def build_arrival_index(trips):
+    """Index every stop_time_update in the feed by (stop_id, route_id) in a single pass."""
+    pending = {}
+    interned = {}
+    for trip in trips:
+        train = None
+        for update in trip.stop_time_updates:
+            arrival = update.arrival
+            if not arrival:
+                continue
+            # TripFeed gives epoch seconds; nyct_gtfs trips give datetimes.
+            if not isinstance(arrival, (int, float)):
+                arrival = arrival.timestamp()
+            if train is None:
+                key = (trip.headsign_text, trip.direction)
+                train = interned.get(key)
+                if train is None:
+                    train = interned[key] = (key, _arrival_prefix(*key))
+            pending.setdefault((update.stop_id, trip.route_id), []).append((arrival, train))
+
+    index = {}
+    for key, arrivals in pending.items():
+        arrivals.sort(key=lambda arrival: arrival[0])
+        index[key] = StopArrivals(
+            epochs=[arrival[0] for arrival in arrivals],
+            trains=[arrival[1][0] for arrival in arrivals],
+            fragments=[arrival[1][1] for arrival in arrivals],
+        )
+    return index
+
+
+def arrival_window(stop_arrivals, now_ts, num_trains):
+    """Return (start, minutes) for the next num_trains arrivals after now_ts."""
+    if stop_arrivals is None:
+        return EMPTY_WINDOW
+    epochs = stop_arrivals.epochs
+    start = bisect_right(epochs, now_ts)
+    return start, tuple(int((epoch - now_ts) / 60) for epoch in epochs[start:start + num_trains])
+
+
+def window_expiry(stop_arrivals, window):
+    """Return the epoch before which every minutes value in window still holds.
+
+    At that instant a train's minutes_until ticks down (or it departs, which
+    also brings the next train into the window).
+    """
+    start, minutes = window
+    if not minutes:
+        return math.inf
+    epochs = stop_arrivals.epochs
+    return min(epochs[start + offset] - 60 * value for offset, value in enumerate(minutes))
+
+
+def encode_window(stop_arrivals, window):
+    """Encode a window from arrival_window as a JSON array."""
+    start, minutes = window
+    if not minutes:
+        return b"[]"
+    fragments = stop_arrivals.fragments
+    return b"[" + b", ".join(
+        fragments[start + offset] + b"%d}" % value for offset, value in enumerate(minutes)
+    ) + b"]"
+
+
+def upcoming_arrivals(index, stop_id, line, now, num_trains):
+    stop_arrivals = index.get((stop_id, line))
+    start, minutes = arrival_window(stop_arrivals, now.timestamp(), num_trains)
+    if not minutes:
+        return []
+    return [
+        {
+            "destination": destination,
+            "direction": direction,
+            "minutes_until": value,
+        }
+        for (destination, direction), value in zip(
+            stop_arrivals.trains[start:start + len(minutes)], minutes
+        )
+    ]
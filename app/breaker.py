@@ -0,0 +1,89 @@
+# Circuit breaker for one upstream endpoint.
+#
+# After FAILURE_THRESHOLD consecutive failures the breaker opens and calls
+# fail fast until a backoff has elapsed; then a single trial call is let
+# through (half-open). A failed trial re-opens the breaker with double the
+# previous backoff, up to MAX_BACKOFF_S. Backoffs are jittered so endpoints
+# that failed together do not all retry at the same moment.
+import os
+import random
+import threading
+import time
+
+FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "3"))
+BASE_BACKOFF_S = float(os.getenv("BREAKER_BASE_BACKOFF_S", "5"))
+MAX_BACKOFF_S = float(os.getenv("BREAKER_MAX_BACKOFF_S", "300"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        failure_threshold=FAILURE_THRESHOLD,
+        base_backoff_s=BASE_BACKOFF_S,
+        max_backoff_s=MAX_BACKOFF_S,
+        clock=time.monotonic,
+        jitter=random.random,
+    ):
+        self.failure_threshold = failure_threshold
+        self.base_backoff_s = base_backoff_s
+        self.max_backoff_s = max_backoff_s
+        self._clock = clock
+        self._jitter = jitter
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.open_until = 0.0
+        self.short_circuited = 0
+
+    def allow(self):
+        """Return True if a call may go upstream now."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and self._clock() >= self.open_until:
+                self.state = HALF_OPEN
+                return True
+            self.short_circuited += 1
+            return False
+
+    def reinit_after_fork(self):
+        # The lock may have been held by another thread of the parent.
+        self._lock = threading.Lock()
+
+    def retry_in(self):
+        return max(self.open_until - self._clock(), 0.0)
+
+    def success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.opened = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                backoff = min(self.base_backoff_s * (2 ** self.opened), self.max_backoff_s)
+                # "Equal jitter": between half and all of the backoff.
+                backoff *= 0.5 + self._jitter() / 2
+                self.state = OPEN
+                self.opened += 1
+                self.open_until = self._clock() + backoff
+
+    def describe(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "retry_in_s": round(self.retry_in(), 1) if self.state == OPEN else None,
+                "short_circuited": self.short_circuited,
+            }
@@ -0,0 +1,112 @@
+# Stop/line registry loaded from a JSON config file.
+#
+# Each board is one key in the /next_trains payload (e.g. "Q_S") bound to a
+# line and a GTFS stop_id. Lines that share a physical NYCT feed (N/Q/R/W,
+# 1-7/S, ...) map to the same feed id so each feed is fetched once.
+import json
+import os
+from typing import NamedTuple
+
+DEFAULT_STOPS_CONFIG = os.path.join(os.path.dirname(__file__), "stops.json")
+STOPS_CONFIG = os.getenv("STOPS_CONFIG", DEFAULT_STOPS_CONFIG)
+
+FEED_BASE_URL = "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2F"
+
+FEED_LINES = {
+    "gtfs": ("1", "2", "3", "4", "5", "6", "6X", "7", "7X", "GS", "S"),
+    "gtfs-ace": ("A", "C", "E", "H", "FS", "SR"),
+    "gtfs-bdfm": ("B", "D", "F", "FX", "M", "SF"),
+    "gtfs-g": ("G",),
+    "gtfs-jz": ("J", "Z"),
+    "gtfs-nqrw": ("N", "Q", "R", "W"),
+    "gtfs-l": ("L",),
+    "gtfs-si": ("SI", "SIR"),
+}
+
+LINE_TO_FEED = {
+    line: feed_id for feed_id, lines in FEED_LINES.items() for line in lines
+}
+
+# Every route in the system, in feed order; /status reports all of them.
+ALL_LINE_IDS = tuple(line for lines in FEED_LINES.values() for line in lines)
+
+
+class Board(NamedTuple):
+    key: str
+    line: str
+    stop_id: str
+    feed_id: str
+    name: str
+
+
+class Registry(NamedTuple):
+    boards: dict
+    line_ids: tuple
+    feed_urls: dict
+    boards_by_stop: dict
+
+
+def feed_url(feed_id):
+    return FEED_BASE_URL + feed_id
+
+
+def build_registry(config):
+    boards = {}
+    boards_by_stop = {}
+    line_ids = []
+    feed_urls = {}
+
+    for key, entry in config.get("boards", {}).items():
+        line = str(entry["line"])
+        stop_id = str(entry["stop_id"])
+        if line not in LINE_TO_FEED:
+            raise ValueError(f"Unknown line {line!r} for board {key!r}")
+        feed_id = LINE_TO_FEED[line]
+        board = Board(
+            key=key,
+            line=line,
+            stop_id=stop_id,
+            feed_id=feed_id,
+            name=entry.get("name", ""),
+        )
+        boards[key] = board
+        boards_by_stop.setdefault(stop_id, []).append(key)
+        if line not in line_ids:
+            line_ids.append(line)
+        feed_urls.setdefault(feed_id, feed_url(feed_id))
+
+    return Registry(
+        boards=boards,
+        line_ids=tuple(line_ids),
+        feed_urls=feed_urls,
+        boards_by_stop={stop_id: tuple(keys) for stop_id, keys in boards_by_stop.items()},
+    )
+
+
+def load_registry(path=STOPS_CONFIG):
+    with open(path, encoding="utf-8") as config_file:
+        return build_registry(json.load(config_file))
+
+
+REGISTRY = load_registry()
+BOARDS = REGISTRY.boards
+LINE_IDS = REGISTRY.line_ids
+
+
+def select_boards(stop_ids=None, registry=None):
+    """Return board keys for the requested stop_ids (all boards if None).
+
+    Raises KeyError naming the first stop_id that no board is configured for.
+    """
+    registry = registry or REGISTRY
+    if not stop_ids:
+        return tuple(registry.boards)
+
+    keys = []
+    for stop_id in stop_ids:
+        if stop_id not in registry.boards_by_stop:
+            raise KeyError(stop_id)
+        for key in registry.boards_by_stop[stop_id]:
+            if key not in keys:
+                keys.append(key)
+    return tuple(keys)
@@ -0,0 +1,65 @@
+# Compressed variants of cached response bodies.
+#
+# A body is compressed at most once per encoding and the result kept with
+# the body, so compression costs scale with the number of distinct bodies
+# (one per snapshot and displayed minute) rather than with requests. Brotli
+# (pinned in requirements.txt) is offered only when the package imports.
+import gzip
+import os
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+# Bodies smaller than this are always sent as-is.
+MIN_COMPRESS_BYTES = int(os.getenv("MIN_COMPRESS_BYTES", "256"))
+
+IDENTITY = "identity"
+
+
+def _gzip(body):
+    # mtime=0 keeps the output identical for identical bodies.
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _brotli(body):
+    return brotli.compress(body, quality=BROTLI_QUALITY)
+
+
+COMPRESSORS = {"gzip": _gzip}
+if brotli is not None:
+    COMPRESSORS["br"] = _brotli
+# Preferred first when a client accepts several equally.
+ENCODINGS = tuple(sorted(COMPRESSORS, key=lambda name: name != "br")) + (IDENTITY,)
+
+
+class EncodedBody:
+    """A response body and its compressed variants, filled in on first use."""
+
+    __slots__ = ("body", "_variants", "_lock")
+
+    def __init__(self, body):
+        self.body = body
+        self._variants = {IDENTITY: body}
+        self._lock = threading.Lock()
+
+    def variant(self, encoding):
+        """Return (encoding, bytes), falling back to identity for tiny bodies."""
+        if encoding == IDENTITY or len(self.body) < MIN_COMPRESS_BYTES:
+            return IDENTITY, self.body
+        encoded = self._variants.get(encoding)
+        if encoded is None:
+            with self._lock:
+                encoded = self._variants.get(encoding)
+                if encoded is None:
+                    encoded = self._variants[encoding] = COMPRESSORS[encoding](self.body)
+        return encoding, encoded
+
+
+def negotiate(accept_encodings):
+    """Pick an encoding from a werkzeug Accept-Encoding header object."""
+    return accept_encodings.best_match(ENCODINGS, default=IDENTITY) or IDENTITY
@@ -0,0 +1,135 @@
+# Selective decode of NYCT trip feeds.
+#
+# NYCTFeed.trips wraps every trip and every stop_time_update of a feed in
+# Python objects, while the boards only ever read a handful of stops.
+# TripFeed walks the parsed FeedMessage once and keeps, per trip, only the
+# stop_time_updates for the configured stop_ids plus the fields the boards
+# and the status fallback read (headsign, direction, route, delay alert).
+# Arrival times stay epoch seconds, as build_arrival_index stores them,
+# rather than round-tripping through datetime.
+# The FeedMessage is dropped as soon as that is done, so nothing but those
+# records stays resident between refreshes.
+import threading
+
+from nyct_gtfs.compiled_gtfs import gtfs_realtime_pb2, nyct_subway_pb2
+from nyct_gtfs.gtfs_static_types import Stations, TripShapes
+
+_STATIC = None
+_STATIC_LOCK = threading.Lock()
+
+
+def _static():
+    # trips.txt and stops.txt are the same for every feed; load them once.
+    global _STATIC
+
+    if _STATIC is None:
+        with _STATIC_LOCK:
+            if _STATIC is None:
+                _STATIC = (TripShapes(), Stations())
+    return _STATIC
+
+
+class StopTime:
+    """A stop_time_update; arrival is epoch seconds, not a datetime as in nyct_gtfs."""
+
+    __slots__ = ("stop_id", "arrival")
+
+    def __init__(self, stop_id, arrival):
+        self.stop_id = stop_id
+        self.arrival = arrival
+
+
+class TripRecord:
+    """The fields of nyct_gtfs.Trip that build_arrival_index and delayed_lines read."""
+
+    __slots__ = ("route_id", "headsign_text", "direction", "has_delay_alert", "stop_time_updates")
+
+    def __init__(self, route_id, headsign_text, direction, has_delay_alert, stop_time_updates):
+        self.route_id = route_id
+        self.headsign_text = headsign_text
+        self.direction = direction
+        self.has_delay_alert = has_delay_alert
+        self.stop_time_updates = stop_time_updates
+
+
+def _shape_id(trip_id):
+    # Same parsing as nyct_gtfs.Trip.shape_id / direction.
+    parts = trip_id.split("_")
+    return parts[1] if len(parts) > 1 else None
+
+
+def _direction(shape_id):
+    if not shape_id:
+        return None
+    parts = shape_id.split("..") if ".." in shape_id else shape_id.split(".")
+    return parts[1][0] if len(parts) > 1 and parts[1] else None
+
+
+def _headsign(trip_update, shape_id, trip_shapes, stations):
+    try:
+        return trip_shapes.get_headsign_text(shape_id)
+    except ValueError:
+        updates = trip_update.stop_time_update
+        if not updates:
+            return None
+        try:
+            return stations.get_station_name(updates[-1].stop_id)
+        except ValueError:
+            return None
+
+
+def decode_trips(message, stop_ids):
+    """Return a TripRecord per trip that stops at one of stop_ids or has a delay alert.
+
+    Matches NYCTFeed.trips for those fields: a trip appearing twice is
+    taken from its last entity, and alerts apply by train_id.
+    """
+    trip_shapes, stations = _static()
+    descriptor = nyct_subway_pb2.nyct_trip_descriptor
+
+    delayed_train_ids = set()
+    trip_updates = {}
+    for entity in message.entity:
+        if entity.HasField("trip_update"):
+            trip = entity.trip_update.trip
+            train_id = trip.Extensions[descriptor].train_id
+            trip_updates[trip.trip_id + " " + train_id[-7:]] = (entity.trip_update, train_id)
+        elif entity.HasField("alert"):
+            for informed in entity.alert.informed_entity:
+                delayed_train_ids.add(informed.trip.Extensions[descriptor].train_id)
+
+    trips = []
+    for trip_update, train_id in trip_updates.values():
+        kept = [
+            StopTime(update.stop_id, update.arrival.time)
+            for update in trip_update.stop_time_update
+            if update.stop_id in stop_ids and update.HasField("arrival")
+        ]
+        delayed = train_id in delayed_train_ids
+        if not kept and not delayed:
+            continue
+        trip_id = trip_update.trip.trip_id
+        shape_id = _shape_id(trip_id)
+        trips.append(TripRecord(
+            route_id=trip_update.trip.route_id,
+            headsign_text=_headsign(trip_update, shape_id, trip_shapes, stations) if kept else None,
+            direction=_direction(shape_id),
+            has_delay_alert=delayed,
+            stop_time_updates=kept,
+        ))
+    return trips
+
+
+class TripFeed:
+    """Stands in for NYCTFeed in the refresher, keeping only stop_ids."""
+
+    def __init__(self, stop_ids):
+        self.stop_ids = frozenset(stop_ids)
+        self.trips = []
+        self.entity_count = 0
+
+    def load_gtfs_bytes(self, gtfs_bytes):
+        message = gtfs_realtime_pb2.FeedMessage()
+        message.ParseFromString(gtfs_bytes)
+        self.entity_count = len(message.entity)
+        self.trips = decode_trips(message, self.stop_ids)
@@ -0,0 +1,68 @@
+# Compiled multi-category keyword matcher shared by the badge classifiers.
+#
+# All keywords are folded into one case-insensitive regex with a named group
+# per category, so one scan of the alert text finds every category present.
+# Keywords match at a word start and may carry a suffix ("delay" matches
+# "delays" and "delayed" but not "undelayed"), which also makes keywords
+# that are prefixes of each other redundant.
+import json
+import os
+import re
+
+KEYWORDS_FILE = os.getenv("ALERT_KEYWORDS_FILE")
+
+
+def _dedupe(keywords):
+    keywords = sorted({keyword.strip().lower() for keyword in keywords if keyword.strip()})
+    kept = []
+    for keyword in keywords:
+        if not any(keyword.startswith(prefix) for prefix in kept):
+            kept.append(keyword)
+    return kept
+
+
+class KeywordMatcher:
+    def __init__(self, categories):
+        groups = []
+        self._group_categories = {}
+        for index, (category, keywords) in enumerate(categories.items()):
+            keywords = _dedupe(keywords)
+            if not keywords:
+                continue
+            alternation = "|".join(
+                re.escape(keyword) for keyword in sorted(keywords, key=len, reverse=True)
+            )
+            group = f"c{index}"
+            groups.append(f"(?P<{group}>\\b(?:{alternation}))")
+            self._group_categories[group] = category
+        self._pattern = re.compile("|".join(groups), re.IGNORECASE) if groups else None
+
+    def find(self, text):
+        """Return the set of categories with at least one keyword in text."""
+        found = set()
+        if not text or self._pattern is None:
+            return found
+        wanted = len(self._group_categories)
+        for match in self._pattern.finditer(text):
+            found.add(self._group_categories[match.lastgroup])
+            if len(found) == wanted:
+                break
+        return found
+
+
+def load_keywords(defaults, path=None):
+    """Return defaults with any categories from the JSON keywords file replaced.
+
+    The file maps category names to keyword lists, e.g.
+    {"DLY": ["delay", "signal problem"], "PLN": ["planned work"]}.
+    """
+    path = path or KEYWORDS_FILE
+    keywords = {category: tuple(words) for category, words in defaults.items()}
+    if not path:
+        return keywords
+    with open(path, encoding="utf-8") as keywords_file:
+        overrides = json.load(keywords_file)
+    for category, words in overrides.items():
+        if category in keywords:
+            keywords[category] = tuple(words)
+    return keywords
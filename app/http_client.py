@@ -0,0 +1,241 @@
+# Shared, connection-pooled HTTP client for the MTA endpoints.
+#
+# Every upstream fetch (trip feeds and alerts) goes through one
+# requests.Session so TCP/TLS connections are kept alive between refreshes.
+# Responses are revalidated with If-None-Match / If-Modified-Since; a 304 is
+# reported as NOT_MODIFIED so callers can skip parsing entirely.
+#
+# Each URL has a circuit breaker (app.breaker): while it is open, fetch()
+# raises CircuitOpenError at once instead of waiting on a dead endpoint, and
+# callers keep serving their last good data. With HEDGE_AFTER_S set, a
+# second identical request is sent if the first has not answered by then,
+# and whichever answers first is used.
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.breaker import CircuitBreaker, CircuitOpenError
+
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+HEDGE_AFTER_S = float(os.getenv("HEDGE_AFTER_S", "0"))
+
+NOT_MODIFIED = object()
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+_VALIDATORS = {}
+_METRICS = {}
+_METRICS_LOCK = threading.Lock()
+_BREAKERS = {}
+_HEDGE_EXECUTOR = None
+
+
+def get_session():
+    global _SESSION
+
+    if _SESSION is None:
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _SESSION = session
+    return _SESSION
+
+
+def _host(url):
+    return urlsplit(url).netloc
+
+
+def _record(host, **deltas):
+    with _METRICS_LOCK:
+        counters = _METRICS.setdefault(host, {
+            "requests": 0,
+            "not_modified": 0,
+            "errors": 0,
+            "bytes_received": 0,
+            "bytes_saved": 0,
+            "short_circuited": 0,
+            "hedged": 0,
+        })
+        for name, value in deltas.items():
+            counters[name] += value
+
+
+def get_breaker(url):
+    breaker = _BREAKERS.get(url)
+    if breaker is None:
+        with _SESSION_LOCK:
+            breaker = _BREAKERS.setdefault(url, CircuitBreaker())
+    return breaker
+
+
+def _get_hedge_executor():
+    global _HEDGE_EXECUTOR
+
+    if _HEDGE_EXECUTOR is None:
+        with _SESSION_LOCK:
+            if _HEDGE_EXECUTOR is None:
+                _HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hedge")
+    return _HEDGE_EXECUTOR
+
+
+def _get(url, headers, timeout, hedge_after_s):
+    session = get_session()
+    if hedge_after_s <= 0:
+        return session.get(url, headers=headers, timeout=timeout)
+
+    executor = _get_hedge_executor()
+    pending = {executor.submit(session.get, url, headers=headers, timeout=timeout)}
+    done, pending = wait(pending, timeout=hedge_after_s)
+    if not done:
+        _record(_host(url), hedged=1)
+        pending.add(executor.submit(session.get, url, headers=headers, timeout=timeout))
+    # Never wait longer than the hedge itself may take, even if no request
+    # ever runs, so the caller always gets an answer or an error.
+    deadline = time.monotonic() + timeout
+    error = None
+    while pending or done:
+        for future in done:
+            try:
+                return future.result()
+            except Exception as exc:
+                error = exc
+        if not pending:
+            break
+        done, pending = wait(
+            pending, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED
+        )
+        if not done:
+            raise requests.Timeout(f"no response from {url} within {timeout}s")
+    raise error
+
+
+def fetch(url, timeout, hedge_after_s=None):
+    """GET url, revalidating against the last response for the same URL.
+
+    Returns the response body, or NOT_MODIFIED when the server answers 304.
+    Raises on connection errors and non-200/304 statuses, and raises
+    CircuitOpenError without a request while the URL's breaker is open.
+    """
+    host = _host(url)
+    breaker = get_breaker(url)
+    if not breaker.allow():
+        _record(host, short_circuited=1)
+        raise CircuitOpenError(f"{url} is failing; retrying in {breaker.retry_in():.0f}s")
+
+    headers = {}
+    validators = _VALIDATORS.get(url)
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+    if hedge_after_s is None:
+        hedge_after_s = HEDGE_AFTER_S
+    try:
+        response = _get(url, headers, timeout, hedge_after_s)
+    except BaseException:
+        breaker.failure()
+        _record(host, requests=1, errors=1)
+        raise
+
+    if response.status_code == 304 and validators:
+        breaker.success()
+        _record(host, requests=1, not_modified=1, bytes_saved=validators["size"])
+        return NOT_MODIFIED
+
+    if response.status_code != 200:
+        breaker.failure()
+        _record(host, requests=1, errors=1)
+        raise RuntimeError(f"Error accessing {url}: HTTP {response.status_code}")
+
+    breaker.success()
+
+    content = response.content
+    _record(host, requests=1, bytes_received=len(content))
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if etag or last_modified:
+        _VALIDATORS[url] = {"etag": etag, "last_modified": last_modified, "size": len(content)}
+    else:
+        _VALIDATORS.pop(url, None)
+    return content
+
+
+def invalidate(url):
+    """Drop stored validators so the next fetch downloads the full body."""
+    _VALIDATORS.pop(url, None)
+
+
+def _pool_stats(host):
+    session = get_session()
+    adapter = session.get_adapter(f"https://{host}")
+    pools = getattr(adapter.poolmanager, "pools", None)
+    if pools is None:
+        return {}
+    opened = 0
+    served = 0
+    for key in list(pools.keys()):
+        if getattr(key, "key_host", None) != host.split(":")[0]:
+            continue
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        opened += pool.num_connections
+        served += pool.num_requests
+    return {
+        "connections_opened": opened,
+        "connections_reused": max(served - opened, 0),
+    }
+
+
+def _reinit_after_fork():
+    # The parent's pooled sockets must not be shared with it, its hedge
+    # threads do not exist here, and a lock held by one of its threads at
+    # fork time would never be released.
+    global _SESSION, _SESSION_LOCK, _METRICS_LOCK, _HEDGE_EXECUTOR
+
+    _SESSION = None
+    _HEDGE_EXECUTOR = None
+    _SESSION_LOCK = threading.Lock()
+    _METRICS_LOCK = threading.Lock()
+    for breaker in list(_BREAKERS.values()):
+        breaker.reinit_after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reinit_after_fork)
+
+
+def get_breakers():
+    return {url: breaker.describe() for url, breaker in list(_BREAKERS.items())}
+
+
+def get_metrics():
+    with _METRICS_LOCK:
+        metrics = {host: dict(counters) for host, counters in _METRICS.items()}
+    for host, counters in metrics.items():
+        counters.update(_pool_stats(host))
+    return metrics
+
+
+def reset():
+    global _SESSION
+
+    with _SESSION_LOCK:
+        if _SESSION is not None:
+            _SESSION.close()
+        _SESSION = None
+    _VALIDATORS.clear()
+    _BREAKERS.clear()
+    with _METRICS_LOCK:
+        _METRICS.clear()
@@ -0,0 +1,680 @@
+# Background refresh of the trip feeds and the alerts feed.
+#
+# The refresher is the only code that talks to the MTA. Every refresh ends
+# with a new Snapshot being published; request handlers only ever read the
+# current snapshot, so the request path does no network I/O.
+#
+# All due sources are fetched concurrently on a small thread pool, and each
+# source publishes its own snapshot as soon as it completes, so a slow feed
+# never holds up the others.
+#
+# The last good snapshot is also written to disk (see app.snapshot_file) and
+# restored on startup, so a fresh process serves stale data immediately
+# instead of waiting for, or failing on, its first fetch.
+#
+# With a shared store configured (app.shared_store), only the worker holding
+# the lease fetches; the others install the snapshots it publishes.
+#
+# Startup never waits on the network: feed parsers are created on first use
+# and the first fetch runs in the background. Until a snapshot is available
+# get_startup() reports the process as not ready.
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
+
+from app import alerts, http_client, metrics, scheduler, shared_store, snapshot_file
+from app.config import LINE_IDS, REGISTRY
+from app.feed_decoder import TripFeed
+from app.arrivals import build_arrival_index
+from app.http_client import NOT_MODIFIED
+
+REFRESH_TTL = timedelta(seconds=20)
+ALERTS_TTL = timedelta(seconds=alerts.ALERTS_TTL_S)
+FEED_TIMEOUT_S = float(os.getenv("FEED_TIMEOUT_S", "10"))
+MAX_FETCH_WORKERS = int(os.getenv("MAX_FETCH_WORKERS", "8"))
+TICK_S = 1.0
+# After a failed snapshot write, wait this long before trying again.
+PERSIST_RETRY_S = 60.0
+
+logger = logging.getLogger(__name__)
+
+# One TripFeed per physical feed that at least one configured board needs,
+# created by _get_feed() the first time the feed is parsed.
+FEEDS = dict.fromkeys(REGISTRY.feed_urls)
+
+ALERTS_SOURCE = "alerts"
+ALERT_STATUS = alerts.AlertStatusCache()
+
+
+class Snapshot(NamedTuple):
+    # Published snapshots are never mutated; the refresher builds a new one.
+    generation: int
+    arrivals: dict
+    alerts: Optional[object]
+    status: dict
+    refreshed_at: Optional[datetime]
+    is_stale: bool
+    sources: dict
+    raw: dict
+    network_status: dict
+    delays: dict
+    # (status, network_status) over time as alerts' active periods start and
+    # end; status and network_status are its value when it was published.
+    status_timeline: Optional[alerts.StatusTimeline]
+
+    @property
+    def restored(self):
+        """True while any source is still serving data restored from disk."""
+        return any(state.get("restored") for state in self.sources.values())
+
+    def status_at(self, now_ts):
+        """Return (status, network_status) in effect at epoch now_ts."""
+        if self.status_timeline is None:
+            return self.status, self.network_status
+        return self.status_timeline.at(now_ts)
+
+    def status_expiry(self, now_ts):
+        """Return the epoch at which status_at(now_ts) next changes."""
+        if self.status_timeline is None:
+            return math.inf
+        return self.status_timeline.next_change(now_ts)
+
+
+EMPTY_SNAPSHOT = Snapshot(
+    generation=0,
+    arrivals={},
+    alerts=None,
+    status=alerts.compute_status_from_alerts(None, LINE_IDS),
+    refreshed_at=None,
+    is_stale=False,
+    sources={},
+    raw={},
+    network_status=alerts.status_from_trip_delays(frozenset()),
+    delays={},
+    status_timeline=None,
+)
+
+_SNAPSHOT = EMPTY_SNAPSHOT
+_PUBLISH_LOCK = threading.Lock()
+_SCHEDULE_LOCK = threading.Lock()
+_START_LOCK = threading.Lock()
+_FEED_LOCK = threading.Lock()
+_PUBLISHED = threading.Condition()
+_SCHEDULES = {}
+_IN_FLIGHT = set()
+_EXECUTOR = None
+_THREAD = None
+_THREAD_PID = None
+_SAVED = None
+_PERSIST_RETRY_AT = 0.0
+_STORE = None
+_ROLE = None
+_SHARED_VERSION = None
+_SHARED_PUBLISHED = None
+_ALERTS_RECORD = (None, None, None)
+# Monotonic time start() was called, how long it took, and how long after
+# it the first snapshot with data was published.
+_STARTED_AT = None
+_STARTUP_S = None
+_READY_S = None
+_STOP = threading.Event()
+
+
+def get_snapshot():
+    return _SNAPSHOT
+
+
+def wait_for_update(generation, timeout):
+    """Block until a snapshot newer than generation is published or timeout."""
+    with _PUBLISHED:
+        _PUBLISHED.wait_for(lambda: _SNAPSHOT.generation != generation, timeout)
+    return _SNAPSHOT
+
+
+def _notify_published():
+    _note_ready()
+    with _PUBLISHED:
+        _PUBLISHED.notify_all()
+
+
+def _note_ready():
+    global _READY_S
+
+    if _READY_S is None and _STARTED_AT is not None and _SNAPSHOT.refreshed_at is not None:
+        _READY_S = time.monotonic() - _STARTED_AT
+        metrics.set_gauge("mta_ready_seconds", _READY_S)
+
+
+def get_startup():
+    """Report whether data is being served yet and how long startup took."""
+    return {
+        "ready": _SNAPSHOT.refreshed_at is not None,
+        "startup_ms": round(_STARTUP_S * 1000, 1) if _STARTUP_S is not None else None,
+        "ready_after_ms": round(_READY_S * 1000, 1) if _READY_S is not None else None,
+    }
+
+
+def install(snapshot):
+    """Publish a snapshot built outside the refresher (fixtures, benchmarks)."""
+    global _SNAPSHOT
+
+    with _PUBLISH_LOCK:
+        _SNAPSHOT = snapshot
+    _notify_published()
+    return snapshot
+
+
+def _source_state(started_at, duration_s, error, previous):
+    state = dict(previous or {})
+    state["last_attempt"] = started_at.isoformat()
+    state["duration_ms"] = int(duration_s * 1000)
+    state["last_error"] = str(error) if error else None
+    if error is None:
+        state["last_refresh"] = started_at.isoformat()
+        state.pop("restored", None)
+    else:
+        state.setdefault("last_refresh", None)
+    return state
+
+
+def _fetch_feed_bytes(feed_id):
+    return http_client.fetch(REGISTRY.feed_urls[feed_id], timeout=FEED_TIMEOUT_S)
+
+
+def _schedule(name):
+    schedule = _SCHEDULES.get(name)
+    if schedule is None:
+        if name == ALERTS_SOURCE:
+            # Every endpoint reports status, so alerts never go idle.
+            schedule = scheduler.AdaptiveSchedule(ALERTS_TTL.total_seconds(), idle_after_s=None)
+        else:
+            schedule = scheduler.AdaptiveSchedule(REFRESH_TTL.total_seconds())
+        schedule = _SCHEDULES.setdefault(name, schedule)
+    return schedule
+
+
+def _record_fetch(name, header_ts=None, modified=True):
+    """Update the source's schedule; returns False if upstream has not republished."""
+    with _SCHEDULE_LOCK:
+        return _schedule(name).fetched(time.monotonic(), time.time(), header_ts, modified)
+
+
+def _refresh_trip_feed(feed_id):
+    with metrics.timed("fetch", source=feed_id):
+        content = _fetch_feed_bytes(feed_id)
+    if content is NOT_MODIFIED:
+        _record_fetch(feed_id, modified=False)
+        return NOT_MODIFIED
+    metrics.set_gauge("mta_feed_bytes", len(content), source=feed_id)
+    changed = _record_fetch(feed_id, scheduler.header_timestamp(content))
+    if not changed and feed_id in _SNAPSHOT.arrivals:
+        # Same FeedHeader timestamp as the feed already indexed: skip the parse.
+        return NOT_MODIFIED
+    try:
+        index, delayed = _index_feed_bytes(feed_id, content)
+    except Exception:
+        http_client.invalidate(REGISTRY.feed_urls[feed_id])
+        raise
+    return content, index, delayed
+
+
+def _get_feed(feed_id):
+    feed = FEEDS[feed_id]
+    if feed is None:
+        with _FEED_LOCK:
+            feed = FEEDS[feed_id]
+            if feed is None:
+                stop_ids = [board.stop_id for board in REGISTRY.boards.values() if board.feed_id == feed_id]
+                feed = FEEDS[feed_id] = TripFeed(stop_ids)
+    return feed
+
+
+def _index_feed_bytes(feed_id, content):
+    feed = _get_feed(feed_id)
+    with metrics.timed("parse", source=feed_id):
+        feed.load_gtfs_bytes(content)
+    entity_count = getattr(feed, "entity_count", None)
+    if entity_count is not None:
+        metrics.set_gauge("mta_feed_entities", entity_count, source=feed_id)
+    with metrics.timed("index", source=feed_id):
+        return build_arrival_index(feed.trips), alerts.delayed_lines(feed.trips)
+
+
+def _refresh_alerts():
+    feed = alerts.fetch_alerts_feed(alerts.MTA_ALERTS_URL)
+    if feed is NOT_MODIFIED:
+        _record_fetch(ALERTS_SOURCE, modified=False)
+        return NOT_MODIFIED
+    header_ts = feed.header.timestamp if feed.header.HasField("timestamp") else None
+    if not _record_fetch(ALERTS_SOURCE, header_ts) and _SNAPSHOT.alerts is not None:
+        return NOT_MODIFIED
+    metrics.set_gauge("mta_feed_entities", len(feed.entity), source=ALERTS_SOURCE)
+    with metrics.timed("classify_alerts", source=ALERTS_SOURCE):
+        return feed, ALERT_STATUS.update_timeline(feed)
+
+
+def _is_stale(sources):
+    return any(
+        sources.get(feed_id, {}).get("last_error") or sources.get(feed_id, {}).get("restored")
+        for feed_id in FEEDS
+    )
+
+
+def _configured_status(network_status):
+    # /status reports every route; /next_trains only the configured lines.
+    return {line: network_status.get(line, {"badge": "UNK"}) for line in LINE_IDS}, network_status
+
+
+def _status_changes(network_status):
+    """Snapshot fields for a status dict or an alerts.StatusTimeline of them."""
+    if not isinstance(network_status, alerts.StatusTimeline):
+        network_status = alerts.StatusTimeline.constant(network_status)
+    timeline = network_status.map(_configured_status)
+    status, network_status = timeline.at(time.time())
+    return {"network_status": network_status, "status": status, "status_timeline": timeline}
+
+
+def _publish(name, started_at, duration_s, result, error):
+    global _SNAPSHOT
+
+    with _PUBLISH_LOCK:
+        current = _SNAPSHOT
+        changes = {}
+        if error is None and result is NOT_MODIFIED:
+            if name != ALERTS_SOURCE and name in current.arrivals:
+                changes["refreshed_at"] = started_at
+        elif error is None and name == ALERTS_SOURCE:
+            changes["alerts"], network_status = result
+            changes.update(_status_changes(network_status))
+        elif error is None:
+            content, index, delayed = result
+            changes["arrivals"] = {**current.arrivals, name: index}
+            changes["raw"] = {**current.raw, name: content}
+            changes["delays"] = {**current.delays, name: delayed}
+            changes["refreshed_at"] = started_at
+            if current.alerts is None and delayed != current.delays.get(name, frozenset()):
+                # No alerts feed yet: fall back to delays flagged in the trip feeds.
+                network_status = alerts.status_from_trip_delays(
+                    frozenset().union(*changes["delays"].values())
+                )
+                changes.update(_status_changes(network_status))
+
+        sources = dict(current.sources)
+        sources[name] = _source_state(started_at, duration_s, error, sources.get(name))
+        sources[name]["not_modified"] = result is NOT_MODIFIED
+        _SNAPSHOT = current._replace(
+            generation=current.generation + 1,
+            is_stale=_is_stale(sources),
+            sources=sources,
+            **changes,
+        )
+        published = _SNAPSHOT
+    _notify_published()
+    return published
+
+
+def _refresh_source(name):
+    started_at = datetime.now()
+    started_mono = time.monotonic()
+    result = None
+    error = None
+    try:
+        if name == ALERTS_SOURCE:
+            result = _refresh_alerts()
+        else:
+            result = _refresh_trip_feed(name)
+    except Exception as exc:
+        error = exc
+        if name != ALERTS_SOURCE:
+            # fetch_alerts_feed counts its own attempts.
+            metrics.inc("mta_upstream_errors_total", source=name)
+        with _SCHEDULE_LOCK:
+            _schedule(name).failed(time.monotonic())
+    finally:
+        with _SCHEDULE_LOCK:
+            _IN_FLIGHT.discard(name)
+    return _publish(name, started_at, time.monotonic() - started_mono, result, error)
+
+
+def _get_executor():
+    global _EXECUTOR
+
+    with _SCHEDULE_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(
+                max_workers=MAX_FETCH_WORKERS, thread_name_prefix="feed-fetch"
+            )
+        return _EXECUTOR
+
+
+def _claim_due_sources(force):
+    now_mono = time.monotonic()
+    claimed = []
+    with _SCHEDULE_LOCK:
+        for name in [*FEEDS, ALERTS_SOURCE]:
+            if name in _IN_FLIGHT:
+                continue
+            schedule = _schedule(name)
+            if not force and not schedule.is_due(now_mono):
+                continue
+            _IN_FLIGHT.add(name)
+            schedule.claim(now_mono)
+            claimed.append(name)
+    return claimed
+
+
+def note_demand(feed_ids):
+    """Record that a request needed these feeds; idle feeds are fetched again at once."""
+    now_mono = time.monotonic()
+    with _SCHEDULE_LOCK:
+        for feed_id in feed_ids:
+            schedule = _SCHEDULES.get(feed_id)
+            if schedule is not None:
+                schedule.note_demand(now_mono)
+
+
+def get_schedules():
+    now_mono = time.monotonic()
+    with _SCHEDULE_LOCK:
+        return {name: schedule.describe(now_mono) for name, schedule in _SCHEDULES.items()}
+
+
+def refresh_due(force=False, block=True):
+    """Fetch every source whose schedule says it is due, concurrently.
+
+    Each source publishes a new snapshot as soon as its own fetch finishes.
+    With block=True this waits for the fetches started by this call and
+    returns the snapshot that is current afterwards.
+    """
+    executor = _get_executor()
+    futures = [executor.submit(_refresh_source, name) for name in _claim_due_sources(force)]
+    if block and futures:
+        wait(futures)
+    return _SNAPSHOT
+
+
+def _snapshot_state(snapshot):
+    return {
+        "refreshed_at": snapshot.refreshed_at,
+        "raw": snapshot.raw,
+        "alerts": snapshot.alerts.SerializeToString() if snapshot.alerts is not None else None,
+        "sources": snapshot.sources,
+    }
+
+
+def _same_data(a, b):
+    return a is not None and a.raw is b.raw and a.alerts is b.alerts
+
+
+def persist(path=None):
+    """Write the current snapshot to disk if its data changed since the last write.
+
+    A failed write (e.g. an unwritable SNAPSHOT_PATH) is logged and not
+    retried for PERSIST_RETRY_S; serving never depends on it.
+    """
+    global _SAVED, _PERSIST_RETRY_AT
+
+    snapshot = _SNAPSHOT
+    if snapshot.refreshed_at is None or _same_data(_SAVED, snapshot):
+        return False
+    if time.monotonic() < _PERSIST_RETRY_AT:
+        return False
+    try:
+        written = snapshot_file.save(_snapshot_state(snapshot), path)
+    except OSError as exc:
+        _PERSIST_RETRY_AT = time.monotonic() + PERSIST_RETRY_S
+        logger.warning("could not save snapshot, retrying in %.0fs: %s", PERSIST_RETRY_S, exc)
+        return False
+    if written:
+        _SAVED = snapshot
+    return written
+
+
+def _install_record(record, restored):
+    """Publish the snapshot described by a saved or shared state record.
+
+    Records carry only raw feed bytes, so the arrival indexes are rebuilt
+    here with the same decoder a refresh uses.
+    """
+    global _SNAPSHOT, _ALERTS_RECORD
+
+    raw = {feed_id: content for feed_id, content in record["raw"].items() if feed_id in FEEDS}
+    arrivals = {}
+    delays = {}
+    for feed_id, content in raw.items():
+        arrivals[feed_id], delays[feed_id] = _index_feed_bytes(feed_id, content)
+    if not arrivals:
+        return False
+
+    feed = None
+    alerts_bytes = record.get("alerts")
+    if alerts_bytes and _ALERTS_RECORD[0] == alerts_bytes:
+        feed, network_status = _ALERTS_RECORD[1:]
+    elif alerts_bytes:
+        feed = alerts.gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(alerts_bytes)
+        network_status = ALERT_STATUS.update_timeline(feed)
+        _ALERTS_RECORD = (alerts_bytes, feed, network_status)
+    else:
+        network_status = alerts.status_from_trip_delays(frozenset().union(*delays.values()))
+
+    sources = {}
+    for name, state in record.get("sources", {}).items():
+        if name in arrivals or (name == ALERTS_SOURCE and feed is not None):
+            sources[name] = dict(state, restored=True, last_error=None) if restored else state
+
+    with _PUBLISH_LOCK:
+        _SNAPSHOT = _SNAPSHOT._replace(
+            generation=_SNAPSHOT.generation + 1,
+            arrivals=arrivals,
+            alerts=feed,
+            refreshed_at=record["refreshed_at"],
+            is_stale=True if restored else _is_stale(sources),
+            sources=sources,
+            raw=raw,
+            delays=delays,
+            **_status_changes(network_status),
+        )
+        installed = _SNAPSHOT
+    _notify_published()
+    return installed
+
+
+def restore(path=None):
+    """Publish the snapshot saved on disk, if any. Returns True if one was restored."""
+    global _SAVED
+
+    record = snapshot_file.load(path)
+    if record is None:
+        return False
+    installed = _install_record(record, restored=True)
+    if not installed:
+        return False
+    _SAVED = installed
+    return True
+
+
+def _get_store():
+    global _STORE
+
+    if _STORE is None and shared_store.SHARED_STORE:
+        _STORE = shared_store.open_store()
+    return _STORE
+
+
+def publish_shared(store):
+    """Publish the current snapshot to the shared store if its data changed."""
+    global _SHARED_PUBLISHED
+
+    snapshot = _SNAPSHOT
+    if snapshot.refreshed_at is None or _same_data(_SHARED_PUBLISHED, snapshot):
+        return False
+    store.publish(snapshot_file.encode(_snapshot_state(snapshot)))
+    _SHARED_PUBLISHED = snapshot
+    return True
+
+
+def sync_shared(store):
+    """Install the snapshot last published to the shared store, if it is new."""
+    global _SHARED_VERSION, _SHARED_PUBLISHED
+
+    version, payload = store.read(_SHARED_VERSION)
+    if payload is None:
+        return False
+    _SHARED_VERSION = version
+    record = snapshot_file.decode(payload)
+    installed = record is not None and _install_record(record, restored=False)
+    if not installed:
+        return False
+    _SHARED_PUBLISHED = installed
+    return True
+
+
+def _holds_lease(store):
+    global _ROLE
+
+    try:
+        leader = store.hold_lease(shared_store.owner_id(), shared_store.LEASE_TTL_S)
+    except Exception:
+        # If the store is unreachable, refresh locally rather than not at all.
+        leader = True
+    _ROLE = "leader" if leader else "follower"
+    return leader
+
+
+def get_role():
+    """Return "leader" or "follower" with a shared store configured, else None."""
+    return _ROLE
+
+
+def _tick():
+    store = _get_store()
+    if store is None:
+        refresh_due(block=False)
+        persist()
+    elif _holds_lease(store):
+        refresh_due(block=False)
+        publish_shared(store)
+        persist()
+    else:
+        sync_shared(store)
+
+
+def _run():
+    while not _STOP.is_set():
+        try:
+            _tick()
+        except Exception:
+            logger.exception("refresher tick failed")
+            metrics.inc("mta_refresh_errors_total")
+        _STOP.wait(TICK_S)
+
+
+def _start_thread():
+    global _THREAD, _THREAD_PID
+
+    _STOP.clear()
+    _THREAD = threading.Thread(target=_run, name="feed-refresher", daemon=True)
+    _THREAD_PID = os.getpid()
+    _THREAD.start()
+    return _THREAD
+
+
+def start():
+    """Restore what is available locally, then refresh from a daemon thread.
+
+    Never waits on the MTA: the first fetch runs in the background, and
+    until it (or a restored snapshot) lands the process is not ready.
+    """
+    global _STARTED_AT, _STARTUP_S, _READY_S
+
+    with _START_LOCK:
+        if _THREAD is not None and _THREAD.is_alive() and _THREAD_PID == os.getpid():
+            return _THREAD
+        _STARTED_AT = time.monotonic()
+        _READY_S = None
+        try:
+            restore()
+        except Exception:
+            pass
+        store = _get_store()
+        if store is not None:
+            try:
+                sync_shared(store)
+            except Exception:
+                pass
+        # With a shared store only the lease holder fetches; the others pick
+        # up its snapshots from the refresher thread.
+        if store is None or _holds_lease(store):
+            refresh_due(force=True, block=False)
+        thread = _start_thread()
+        _STARTUP_S = time.monotonic() - _STARTED_AT
+        metrics.set_gauge("mta_startup_seconds", _STARTUP_S)
+        _note_ready()
+        return thread
+
+
+def ensure_running():
+    """Start the refresher thread if this process does not have one.
+
+    Threads do not survive fork(), so workers forked from a preloaded app
+    start their own refresher on their first request. The snapshot inherited
+    from the parent keeps being served meanwhile. Does nothing if the
+    refresher was never started.
+    """
+    if _THREAD_PID is None or (_THREAD is not None and _THREAD_PID == os.getpid()):
+        return _THREAD
+    with _START_LOCK:
+        if _THREAD is not None and _THREAD_PID == os.getpid():
+            return _THREAD
+        return _start_thread()
+
+
+def _reinit_after_fork():
+    global _PUBLISH_LOCK, _SCHEDULE_LOCK, _START_LOCK, _FEED_LOCK, _PUBLISHED, _EXECUTOR, _THREAD, _STORE
+
+    _PUBLISH_LOCK = threading.Lock()
+    _SCHEDULE_LOCK = threading.Lock()
+    _START_LOCK = threading.Lock()
+    _FEED_LOCK = threading.Lock()
+    _PUBLISHED = threading.Condition()
+    _EXECUTOR = None
+    _THREAD = None
+    # Connections to the shared store are not fork-safe.
+    _STORE = None
+    _IN_FLIGHT.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reinit_after_fork)
+
+
+def stop():
+    global _THREAD
+
+    _STOP.set()
+    if _THREAD is not None and _THREAD_PID == os.getpid():
+        _THREAD.join(timeout=5)
+    _THREAD = None
+
+
+def reset():
+    global _SNAPSHOT, _SAVED, _SHARED_VERSION, _SHARED_PUBLISHED, _ROLE
+    global _STARTED_AT, _STARTUP_S, _READY_S, _PERSIST_RETRY_AT
+
+    with _PUBLISH_LOCK, _SCHEDULE_LOCK:
+        _SNAPSHOT = EMPTY_SNAPSHOT
+        _SAVED = None
+        _PERSIST_RETRY_AT = 0.0
+        _SHARED_VERSION = None
+        _SHARED_PUBLISHED = None
+        _ROLE = None
+        _STARTED_AT = _STARTUP_S = _READY_S = None
+        _SCHEDULES.clear()
+        _IN_FLIGHT.clear()
+    _notify_published()
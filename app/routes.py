@@ -1,149 +1,482 @@
-from flask import Blueprint, Response, redirect
-from nyct_gtfs import NYCTFeed
-from datetime import datetime, timedelta, timezone
+from flask import Blueprint, Response, g, redirect, request
+from datetime import datetime, timezone
+from typing import NamedTuple
+import hashlib
+import math
 import os
 import json
+import threading
+import time
 
-from app.alerts import get_alerts_status
+from app import http_client, metrics, refresher, stream
+from app.arrivals import arrival_window, encode_window, window_expiry
+from app.config import BOARDS, select_boards
+from app.encoding import IDENTITY, EncodedBody, negotiate
 
 bp = Blueprint("main", __name__)
 
-# Stop IDs
-STOP_IDS = {
-    "Q": {"S": "Q03S", "N": "Q03N"},     # 72nd St
-    "6": {"S": "627S", "N": "627N"}      # 77th St
-}
-
 NUM_TRAINS = int(os.getenv("NUM_TRAINS", "8"))
+RESPONSE_CACHE_SIZE = 32
+# Encoded /boards results kept for repeated batch shapes, least recently used evicted first.
+BOARDS_CACHE_SIZE = int(os.getenv("BOARDS_CACHE_SIZE", "64"))
+MAX_BOARD_LIMIT = 50
+# Number of recent /next_trains versions a ?since= delta can be computed from.
+DELTA_HISTORY = int(os.getenv("DELTA_HISTORY", "64"))
 
-# Load both feeds
-FEEDS = {
-    "Q": NYCTFeed("Q"),
-    "6": NYCTFeed("6")
-}
+class EncodedStatus(NamedTuple):
+    network_status: dict
+    source: str
+    etag: str
+    body: bytes
+    encoded: EncodedBody
 
-REFRESH_TTL = timedelta(seconds=20)
-LAST_REFRESH = datetime.min
-LAST_RESPONSE_DATA = None
-LAST_RESPONSE_AT = None
+class CachedResponse(NamedTuple):
+    generation: int
+    view: tuple
+    etag: str
+    body: bytes
+    keys: tuple
+    boards: tuple
+    versions: tuple
+    status: dict
+    valid_until: float
+    encoded: EncodedBody
 
-def get_upcoming_trains(feed, stop_id, num_trains=NUM_TRAINS):
-    now = datetime.now()
-    upcoming = []
-    for trip in feed.trips:
-        for update in trip.stop_time_updates:
-            if update.stop_id == stop_id and update.arrival and update.arrival > now:
-                minutes_until = int((update.arrival - now).total_seconds() / 60)
-                upcoming.append({
-                    "destination": trip.headsign_text,
-                    "direction": trip.direction,
-                    "minutes_until": minutes_until
-                })
-    upcoming.sort(key=lambda x: x["minutes_until"])
-    return upcoming[:num_trains]
-
-def build_output():
-    output = {}
-    for line, directions in STOP_IDS.items():
-        feed = FEEDS[line]
-        for direction, stop_id in directions.items():
-            key = f"{line}_{direction}"
-            output[key] = get_upcoming_trains(feed, stop_id)
-    return output
-
-def build_response_payload(output, now, is_stale, status):
+class DeltaBase(NamedTuple):
+    keys: tuple
+    versions: tuple
+    status: dict
+
+# Encoded /next_trains bodies keyed by the selected board keys. Entries are
+# replaced wholesale, never mutated.
+_RESPONSE_CACHE = {}
+_RESPONSE_CACHE_LOCK = threading.Lock()
+
+# Encoded /boards bodies keyed by (board keys, per-board limits).
+_BOARDS_CACHE = {}
+
+# Board versions and status of recently served bodies, keyed by ETag, so a
+# client can ask for only what changed since the body it has.
+_DELTA_BASES = {}
+
+# Encoded status for the most recent status dict, which the refresher only
+# replaces when the alerts change.
+_STATUS_BYTES = (None, b"{}")
+_ENCODED_KEYS = {}
+_ENCODED_NETWORK_STATUS = EncodedStatus(None, None, None, None, None)
+
+def _board_windows(snapshot, now, keys, limits):
+    now_ts = now.timestamp()
+    windows = []
+    for key, limit in zip(keys, limits):
+        board = BOARDS[key]
+        stop_arrivals = snapshot.arrivals.get(board.feed_id, {}).get((board.stop_id, board.line))
+        windows.append((stop_arrivals, arrival_window(stop_arrivals, now_ts, limit)))
+    return windows
+
+def _encode_status(status):
+    global _STATUS_BYTES
+
+    cached_status, encoded = _STATUS_BYTES
+    if cached_status is not status:
+        encoded = json.dumps(status).encode("utf-8")
+        _STATUS_BYTES = (status, encoded)
+    return encoded
+
+def _status_source(snapshot):
+    if snapshot.alerts is not None:
+        return "alerts"
+    if snapshot.delays:
+        return "trip_updates"
+    return "none"
+
+def get_encoded_status(snapshot, now_ts=None):
+    """Return the encoded /status body, rebuilt only when the status changes."""
+    global _ENCODED_NETWORK_STATUS
+
+    if now_ts is None:
+        now_ts = time.time()
+    _, network_status = snapshot.status_at(now_ts)
+    encoded = _ENCODED_NETWORK_STATUS
+    source = _status_source(snapshot)
+    if encoded.network_status is network_status and encoded.source == source:
+        return encoded
+    body = json.dumps({"meta": {"source": source}, "status": network_status}).encode("utf-8")
+    encoded = EncodedStatus(
+        network_status, source, hashlib.sha1(body).hexdigest(), body, EncodedBody(body)
+    )
+    _ENCODED_NETWORK_STATUS = encoded
+    return encoded
+
+def _encode_meta(now, snapshot, **extra):
     cache_age_s = 0
-    if LAST_RESPONSE_AT:
-        cache_age_s = int((now - LAST_RESPONSE_AT).total_seconds())
+    if snapshot.refreshed_at:
+        cache_age_s = int((now - snapshot.refreshed_at).total_seconds())
+    meta = {
+        "generated_at": datetime.now(timezone.utc).replace(microsecond=0).isoformat().replace("+00:00", "Z"),
+        "cache_age_s": cache_age_s,
+        "is_stale": snapshot.is_stale,
+        "restored": snapshot.restored,
+    }
+    meta.update(extra)
+    return json.dumps(meta).encode("utf-8")
 
-    payload = {
-        "meta": {
-            "generated_at": datetime.now(timezone.utc).replace(microsecond=0).isoformat().replace("+00:00", "Z"),
-            "cache_age_s": cache_age_s,
-            "is_stale": is_stale,
-        },
-        "status": status,
+def _encode_key(key):
+    encoded = _ENCODED_KEYS.get(key)
+    if encoded is None:
+        encoded = _ENCODED_KEYS[key] = json.dumps(key).encode("utf-8")
+    return encoded
+
+def _note_demand(keys):
+    refresher.note_demand(frozenset(BOARDS[key].feed_id for key in keys))
+
+def _store_response(cache_key, cached, new_version=False, batch=False):
+    cache, size = (_BOARDS_CACHE, BOARDS_CACHE_SIZE) if batch else (_RESPONSE_CACHE, RESPONSE_CACHE_SIZE)
+    with _RESPONSE_CACHE_LOCK:
+        cache.pop(cache_key, None)
+        cache[cache_key] = cached
+        while len(cache) > size:
+            cache.pop(next(iter(cache)), None)
+        if new_version:
+            _DELTA_BASES[cached.etag] = DeltaBase(cached.keys, cached.versions, cached.status)
+            while len(_DELTA_BASES) > DELTA_HISTORY:
+                _DELTA_BASES.pop(next(iter(_DELTA_BASES)), None)
+
+def _board_version(board):
+    return hashlib.blake2b(board, digest_size=6).hexdigest()
+
+def _batch_status(status, keys):
+    """Status of just the lines the boards in keys belong to."""
+    lines = dict.fromkeys(BOARDS[key].line for key in keys)
+    return {line: status.get(line, {"badge": "UNK"}) for line in lines}
+
+def get_encoded_response(snapshot, now, keys=None):
+    """Return (CachedResponse, hit) for /next_trains; see _get_encoded."""
+    if keys is None:
+        keys = tuple(BOARDS)
+    return _get_encoded(snapshot, now, keys, keys, (NUM_TRAINS,) * len(keys))
+
+def get_encoded_boards(snapshot, now, keys, limits):
+    """Return (CachedResponse, hit) for a /boards batch with per-board limits.
+
+    The body nests the boards under "boards" and carries status only for
+    their lines.
+    """
+    return _get_encoded(snapshot, now, (keys, limits), keys, limits, batch=True)
+
+def _get_encoded(snapshot, now, cache_key, keys, limits, batch=False):
+    """Return (CachedResponse, hit) for the current snapshot and time.
+
+    Within one snapshot generation the body is reused without looking at
+    the arrivals again until valid_until, the first instant a displayed
+    minutes value or an alert's active period changes. Otherwise the
+    boards are recomputed and the body is reused if they and the status
+    are unchanged within the generation; in a new generation it is joined
+    from the arrivals' pre-encoded fragments, the status encoded once per
+    alerts refresh and a fresh meta, keeping the ETag if only meta differs.
+    """
+    cached = (_BOARDS_CACHE if batch else _RESPONSE_CACHE).get(cache_key)
+    if (
+        cached
+        and cached.generation == snapshot.generation
+        and now.timestamp() < cached.valid_until
+    ):
+        if batch:
+            _store_response(cache_key, cached, batch=True)
+        return cached, True
+
+    now_ts = now.timestamp()
+    with metrics.timed("build_output"):
+        windows = _board_windows(snapshot, now, keys, limits)
+    view = tuple(window for _, window in windows)
+    snapshot_status, _ = snapshot.status_at(now_ts)
+    valid_until = min(
+        (window_expiry(stop_arrivals, window) for stop_arrivals, window in windows),
+        default=math.inf,
+    )
+    valid_until = min(valid_until, snapshot.status_expiry(now_ts))
+    if (
+        cached
+        and cached.generation == snapshot.generation
+        and cached.view == view
+        and cached.status is snapshot_status
+    ):
+        cached = cached._replace(valid_until=valid_until)
+        _store_response(cache_key, cached, batch=batch)
+        return cached, True
+
+    with metrics.timed("encode"):
+        if batch:
+            status = json.dumps(_batch_status(snapshot_status, keys)).encode("utf-8")
+        else:
+            status = _encode_status(snapshot_status)
+        encoded_boards = tuple(
+            encode_window(stop_arrivals, window) for stop_arrivals, window in windows
+        )
+        boards = b"".join(
+            b", " + _encode_key(key) + b": " + board for key, board in zip(keys, encoded_boards)
+        )
+        etag = hashlib.sha1(
+            status + (b"stale" if snapshot.is_stale else b"fresh") + boards
+        ).hexdigest()
+        # Same boards and status as the cached body: keep its ETag and board
+        # versions, but re-encode the meta, which describes this snapshot.
+        unchanged = cached is not None and cached.etag == etag
+        if unchanged:
+            versions = cached.versions
+        else:
+            versions = tuple(_board_version(board) for board in encoded_boards)
+        meta = _encode_meta(now, snapshot, versions=dict(zip(keys, versions)))
+        if batch:
+            body = b'{"meta": ' + meta + b', "status": ' + status + b', "boards": {' + boards[2:] + b"}}"
+        else:
+            body = b'{"meta": ' + meta + b', "status": ' + status + boards + b"}"
+
+    cached = CachedResponse(
+        generation=snapshot.generation,
+        view=view,
+        etag=etag,
+        body=body,
+        keys=keys,
+        boards=encoded_boards,
+        versions=versions,
+        status=snapshot_status,
+        valid_until=valid_until,
+        encoded=EncodedBody(body),
+    )
+    # ?since= deltas are only offered on /next_trains.
+    _store_response(cache_key, cached, new_version=not (batch or unchanged), batch=batch)
+    return cached, unchanged
+
+def get_delta_body(cached, since, snapshot, now):
+    """Encode only the boards and status lines that changed since the ETag since.
+
+    Returns None when since is not a recent version of the same board
+    selection; the caller then sends the full body.
+    """
+    base = _DELTA_BASES.get(since)
+    if base is None or base.keys != cached.keys:
+        return None
+    changed = [
+        index for index, (old, new) in enumerate(zip(base.versions, cached.versions)) if old != new
+    ]
+    status = {
+        line: entry for line, entry in cached.status.items() if base.status.get(line) != entry
     }
-    payload.update(output)
-    return payload
+    meta = _encode_meta(
+        now,
+        snapshot,
+        delta=True,
+        since=since,
+        versions={cached.keys[index]: cached.versions[index] for index in changed},
+    )
+    boards = b"".join(
+        b", " + _encode_key(cached.keys[index]) + b": " + cached.boards[index] for index in changed
+    )
+    return b'{"meta": ' + meta + b', "status": ' + json.dumps(status).encode("utf-8") + boards + b"}"
+
+def _bytes_response(
+    body, status_code=200, headers=None, cache_control="no-store", content_encoding=IDENTITY
+):
+    response = Response(body, status=status_code, content_type="application/json")
+    response.headers["Content-Length"] = str(len(body))
+    response.headers["Connection"] = "close"
+    response.headers["Content-Encoding"] = content_encoding
+    response.headers["Cache-Control"] = cache_control
+    for name, value in (headers or {}).items():
+        response.headers[name] = value
+    response.direct_passthrough = False
+    return response
+
+def _conditional_response(etag, body, headers):
+    """Send body (bytes, or an EncodedBody to negotiate a variant) unless the client has it.
+
+    Compressed variants get their own ETag, "<etag>-<encoding>"; either form
+    revalidates. If-None-Match uses weak comparison, so a tag a proxy
+    weakened (W/"...") when it re-encoded the body still matches.
+    """
+    encoding = IDENTITY
+    if isinstance(body, EncodedBody):
+        encoding, body = body.variant(negotiate(request.accept_encodings))
+    headers = dict(headers, Vary="Accept-Encoding")
+    variant_etag = etag if encoding == IDENTITY else f"{etag}-{encoding}"
+    headers["ETag"] = f'"{variant_etag}"'
+    if request.if_none_match.contains_weak(etag) or request.if_none_match.contains_weak(variant_etag):
+        response = Response(status=304)
+        response.headers["Cache-Control"] = "no-cache"
+        for name, value in headers.items():
+            response.headers[name] = value
+        return response
+    return _bytes_response(body, headers=headers, cache_control="no-cache", content_encoding=encoding)
+
+def _json_response(payload, status_code=200, headers=None):
+    return _bytes_response(json.dumps(payload).encode("utf-8"), status_code, headers)
+
+@bp.before_app_request
+def _ensure_refresher():
+    # Restarts the refresher in forked workers; a no-op once it is running.
+    refresher.ensure_running()
+
+@bp.before_app_request
+def _start_profile():
+    g.profiler = metrics.start_profile()
+
+@bp.after_app_request
+def _finish_profile(response):
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        metrics.finish_profile(profiler, f"{request.method} {request.full_path}")
+    return response
 
 @bp.route("/health")
 def health():
     now = datetime.now()
+    snapshot = refresher.get_snapshot()
     cache_age = None
-    if LAST_RESPONSE_AT:
-        cache_age = int((now - LAST_RESPONSE_AT).total_seconds())
+    if snapshot.refreshed_at:
+        cache_age = int((now - snapshot.refreshed_at).total_seconds())
 
+    startup = refresher.get_startup()
     payload = {
-        "status": "ok",
+        "status": "ok" if startup["ready"] else "starting",
+        "ready": startup["ready"],
+        "startup": startup,
         "cache_age_seconds": cache_age,
-        "last_refresh": None if LAST_REFRESH == datetime.min else LAST_REFRESH.isoformat()
+        "last_refresh": snapshot.refreshed_at.isoformat() if snapshot.refreshed_at else None,
+        "feeds": snapshot.sources,
+        "upstream": http_client.get_metrics(),
+        "breakers": http_client.get_breakers(),
+        "stream_clients": stream.client_count(),
+        "refresh_role": refresher.get_role(),
+        "schedule": refresher.get_schedules(),
     }
-    response_data = json.dumps(payload)
-    response = Response(response_data, content_type="application/json")
-    response.headers["Content-Length"] = str(len(response_data))
-    response.headers["Connection"] = "close"
-    response.headers["Content-Encoding"] = "identity"
+    return _json_response(payload)
+
+@bp.route("/metrics")
+def metrics_endpoint():
+    body = metrics.render().encode("utf-8")
+    response = Response(body, content_type="text/plain; version=0.0.4; charset=utf-8")
     response.headers["Cache-Control"] = "no-store"
-    response.direct_passthrough = False
     return response
 
 @bp.route("/")
 def index():
     return redirect("/health", code=302)
 
+def _requested_stop_ids():
+    stops = request.args.get("stops")
+    if not stops:
+        return None
+    return [stop_id.strip() for stop_id in stops.split(",") if stop_id.strip()]
+
 @bp.route("/next_trains")
 def next_trains():
-    global LAST_REFRESH, LAST_RESPONSE_DATA, LAST_RESPONSE_AT
+    snapshot = refresher.get_snapshot()
+    if snapshot.refreshed_at is None:
+        return _json_response({"error": "arrivals not available yet"}, 503, {"Retry-After": "5"})
 
     try:
-        now = datetime.now()
-        if now - LAST_REFRESH >= REFRESH_TTL:
-            for feed in FEEDS.values():
-                feed.refresh()
-            LAST_REFRESH = now
-
-        # Build output only for southbound directions
-        output = build_output()
-        status = get_alerts_status(now)
-        LAST_RESPONSE_DATA = output
-        LAST_RESPONSE_AT = now
-        response_payload = build_response_payload(output, now, False, status)
-        response_data = json.dumps(response_payload)
-
-        # Build proper JSON response
-        response = Response(response_data, content_type="application/json")
-        response.headers["Content-Length"] = str(len(response_data))
-        response.headers["Connection"] = "close"
-        response.headers["Content-Encoding"] = "identity"
-        response.headers["Cache-Control"] = "no-store"
-        response.headers["X-Cache"] = "miss"
-        response.direct_passthrough = False
-        return response
+        keys = select_boards(_requested_stop_ids())
+    except KeyError as e:
+        return _json_response({"error": f"unknown stop: {e.args[0]}"}, 400)
+
+    _note_demand(keys)
+    now = datetime.now()
+    with metrics.timed("next_trains"):
+        cached, hit = get_encoded_response(snapshot, now, keys)
+
+    headers = {}
+    if snapshot.is_stale:
+        headers["X-Cache"] = "stale"
+        headers["X-Cache-Age-Seconds"] = str(int((now - snapshot.refreshed_at).total_seconds()))
+    else:
+        headers["X-Cache"] = "hit" if hit else "miss"
+    metrics.inc("mta_responses_total", cache=headers["X-Cache"])
+
+    # Accept the ETag of any variant; the encoding suffix is not part of the version.
+    since = request.args.get("since", "").strip().removeprefix("W/").strip('"').partition("-")[0]
+    if since:
+        delta = get_delta_body(cached, since, snapshot, now)
+        headers["X-Delta"] = "full" if delta is None else "delta"
+        if delta is not None:
+            # A delta is a different representation from the full body, so it
+            # must not share its validator.
+            return _conditional_response(f"{cached.etag}-since-{since}", delta, headers)
 
-    except Exception as e:
-        if LAST_RESPONSE_DATA:
-            now = datetime.now()
-            status = get_alerts_status(now)
-            response_payload = build_response_payload(LAST_RESPONSE_DATA, now, True, status)
-            response_data = json.dumps(response_payload)
-            response = Response(response_data, content_type="application/json")
-            response.headers["Content-Length"] = str(len(response_data))
-            response.headers["Connection"] = "close"
-            response.headers["Content-Encoding"] = "identity"
-            response.headers["Cache-Control"] = "no-store"
-            response.headers["X-Cache"] = "stale"
-            response.headers["X-Cache-Age-Seconds"] = str(
-                int((now - LAST_RESPONSE_AT).total_seconds())
-            )
-            response.direct_passthrough = False
-            return response, 200
-
-        error_data = json.dumps({"error": str(e)})
-        response = Response(error_data, content_type="application/json")
-        response.headers["Content-Length"] = str(len(error_data))
-        response.headers["Connection"] = "close"
-        response.headers["Content-Encoding"] = "identity"
-        response.headers["Cache-Control"] = "no-store"
-        response.direct_passthrough = False
-        return response, 500
+    return _conditional_response(cached.etag, cached.encoded, headers)
+
+def _parse_limit(value):
+    if not value.isdigit() or not 1 <= int(value) <= MAX_BOARD_LIMIT:
+        raise ValueError(value)
+    return int(value)
+
+def _requested_boards():
+    """Parse ?stops=STOP[:LIMIT],...&limit=N into (keys, limits).
+
+    Raises KeyError for an unknown stop_id and ValueError for a bad limit.
+    """
+    # NUM_TRAINS is configuration, not input: cap it rather than reject it.
+    limit = request.args.get("limit")
+    default_limit = min(NUM_TRAINS, MAX_BOARD_LIMIT) if limit is None else _parse_limit(limit)
+    stop_limits = {}
+    for item in request.args.get("stops", "").split(","):
+        stop_id, _, limit = item.strip().partition(":")
+        if stop_id:
+            stop_limits[stop_id] = _parse_limit(limit) if limit else default_limit
+    keys = select_boards(list(stop_limits))
+    if not stop_limits:
+        return keys, (default_limit,) * len(keys)
+    return keys, tuple(stop_limits[BOARDS[key].stop_id] for key in keys)
+
+@bp.route("/boards")
+def boards():
+    snapshot = refresher.get_snapshot()
+    if snapshot.refreshed_at is None:
+        return _json_response({"error": "arrivals not available yet"}, 503, {"Retry-After": "5"})
+
+    try:
+        keys, limits = _requested_boards()
+    except KeyError as e:
+        return _json_response({"error": f"unknown stop: {e.args[0]}"}, 400)
+    except ValueError as e:
+        return _json_response({"error": f"invalid limit: {e.args[0]}"}, 400)
+
+    _note_demand(keys)
+    now = datetime.now()
+    with metrics.timed("boards"):
+        cached, hit = get_encoded_boards(snapshot, now, keys, limits)
+
+    headers = {"X-Cache": "stale" if snapshot.is_stale else ("hit" if hit else "miss")}
+    metrics.inc("mta_boards_responses_total", cache=headers["X-Cache"])
+    return _conditional_response(cached.etag, cached.encoded, headers)
+
+@bp.route("/status")
+def network_status():
+    snapshot = refresher.get_snapshot()
+    encoded = get_encoded_status(snapshot, time.time())
+    return _conditional_response(encoded.etag, encoded.encoded, {})
+
+@bp.route("/next_trains/stream")
+def next_trains_stream():
+    try:
+        keys = select_boards(_requested_stop_ids())
+    except KeyError as e:
+        return _json_response({"error": f"unknown stop: {e.args[0]}"}, 400)
+
+    if not stream.acquire_slot():
+        return _json_response({"error": "too many stream clients"}, 503, {"Retry-After": "30"})
+
+    def render(snapshot, now):
+        # Open streams keep their feeds from going idle.
+        _note_demand(keys)
+        cached, _ = get_encoded_response(snapshot, now, keys)
+        return cached.etag, cached.body
+
+    response = Response(
+        stream.event_stream(render, request.headers.get("Last-Event-ID")),
+        content_type="text/event-stream",
+    )
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    response.call_on_close(stream.release_slot)
+    return response
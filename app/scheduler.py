@@ -0,0 +1,128 @@
+# Adaptive refresh schedule for one upstream source.
+#
+# Instead of a fixed TTL, each source learns how often upstream publishes
+# from the FeedHeader timestamps it sees and fetches shortly after the next
+# publish is expected. A fetch that finds the same timestamp (or a 304) is
+# retried sooner rather than waiting a full interval. Sources nobody has
+# asked about for IDLE_AFTER_S drop to IDLE_REFRESH_S until the next request
+# for them, which makes them due immediately.
+import os
+import time
+
+from nyct_gtfs.compiled_gtfs import gtfs_realtime_pb2
+
+MIN_INTERVAL_S = float(os.getenv("MIN_REFRESH_INTERVAL_S", "5"))
+PUBLISH_LAG_S = 2.0
+IDLE_AFTER_S = float(os.getenv("IDLE_AFTER_S", "3600"))
+IDLE_REFRESH_S = float(os.getenv("IDLE_REFRESH_S", "300"))
+# Weight of the newest gap in the publish interval estimate.
+INTERVAL_SMOOTHING = 0.3
+
+
+def _read_varint(data, position):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+        if shift > 63:
+            raise ValueError("varint too long")
+
+
+def header_timestamp(content):
+    """Return FeedHeader.timestamp without parsing the rest of the feed.
+
+    The header is field 1 and serializers write it first; returns None if
+    it is not found there.
+    """
+    try:
+        if not content or content[0] != 0x0A:
+            return None
+        length, start = _read_varint(content, 1)
+        header = gtfs_realtime_pb2.FeedHeader()
+        header.ParseFromString(content[start:start + length])
+    except Exception:
+        return None
+    return header.timestamp if header.HasField("timestamp") else None
+
+
+class AdaptiveSchedule:
+    def __init__(self, base_interval_s, idle_after_s=IDLE_AFTER_S, clock=time.monotonic):
+        self.base_interval_s = base_interval_s
+        self.idle_after_s = idle_after_s
+        self.publish_interval_s = None
+        self.last_header_ts = None
+        self.next_due = 0.0
+        self.last_demand = clock()
+        self.fetches = 0
+        self.skipped = 0
+
+    def interval(self, now):
+        if self.is_idle(now):
+            return max(IDLE_REFRESH_S, self.base_interval_s)
+        if self.publish_interval_s is None:
+            return self.base_interval_s
+        return self.publish_interval_s
+
+    def is_idle(self, now):
+        return self.idle_after_s is not None and now - self.last_demand > self.idle_after_s
+
+    def is_due(self, now):
+        return now >= self.next_due
+
+    def claim(self, now):
+        # Provisional; replaced once the fetch reports back.
+        self.next_due = now + self.interval(now)
+
+    def fetched(self, now, wall_now, header_ts=None, modified=True):
+        """Record a completed fetch; returns False if the feed had not changed."""
+        self.fetches += 1
+        if not modified or (header_ts is not None and header_ts == self.last_header_ts):
+            self.skipped += 1
+            retry = max(MIN_INTERVAL_S, self.interval(now) / 4)
+            self.next_due = now + min(retry, self.interval(now))
+            return False
+
+        if header_ts is not None and self.last_header_ts is not None and header_ts > self.last_header_ts:
+            gap = min(max(header_ts - self.last_header_ts, MIN_INTERVAL_S), self.base_interval_s)
+            if self.publish_interval_s is None:
+                self.publish_interval_s = gap
+            else:
+                self.publish_interval_s += INTERVAL_SMOOTHING * (gap - self.publish_interval_s)
+        if header_ts is not None:
+            self.last_header_ts = header_ts
+
+        interval = self.interval(now)
+        if header_ts is None or self.is_idle(now):
+            self.next_due = now + interval
+        else:
+            # Fetch just after the next publish is expected.
+            delay = header_ts + interval + PUBLISH_LAG_S - wall_now
+            self.next_due = now + min(max(delay, MIN_INTERVAL_S), interval + PUBLISH_LAG_S)
+        return True
+
+    def failed(self, now):
+        self.next_due = now + self.interval(now)
+
+    def note_demand(self, now):
+        """Record a request for this source; an idle source becomes due at once."""
+        was_idle = self.is_idle(now)
+        self.last_demand = now
+        if was_idle:
+            self.next_due = now
+
+    def describe(self, now):
+        return {
+            "interval_s": round(self.interval(now), 1),
+            "publish_interval_s": (
+                round(self.publish_interval_s, 1) if self.publish_interval_s is not None else None
+            ),
+            "next_due_in_s": round(max(self.next_due - now, 0.0), 1),
+            "idle": self.is_idle(now),
+            "fetches": self.fetches,
+            "skipped_unchanged": self.skipped,
+        }
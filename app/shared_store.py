@@ -0,0 +1,148 @@
+# Snapshot store shared by every worker process of one deployment.
+#
+# With SHARED_STORE set, the workers elect a leader through a lease that
+# expires unless it is renewed. Only the leader fetches from the MTA; it
+# publishes each new snapshot (in the on-disk snapshot format: a JSON header
+# and raw protobuf bytes, never pickles) and the other workers re-index
+# whatever was published last. A worker that dies simply stops renewing,
+# and another one takes over once the lease expires.
+#
+#   SHARED_STORE=file:///var/run/mta/store   memory-mapped file + flock
+#   SHARED_STORE=redis://localhost:6379/0    any Redis-compatible server
+import json
+import mmap
+import os
+import socket
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+SHARED_STORE = os.getenv("SHARED_STORE", "")
+LEASE_TTL_S = float(os.getenv("SHARED_LEASE_TTL_S", "10"))
+
+
+def owner_id():
+    # Evaluated per call so forked workers get their own id.
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class FileStore:
+    """Snapshot in a file that readers memory-map; the lease is a flock-guarded record."""
+
+    def __init__(self, directory):
+        if fcntl is None:
+            raise RuntimeError("the file shared store needs fcntl (POSIX)")
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._data_path = os.path.join(directory, "snapshot.bin")
+        self._lease_path = os.path.join(directory, "lease.json")
+        self._lock_path = os.path.join(directory, "lease.lock")
+
+    def hold_lease(self, owner, ttl_s):
+        """Take the lease, or renew it if owner already holds it."""
+        with open(self._lock_path, "a+") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self._lease_path, encoding="utf-8") as lease_file:
+                        lease = json.load(lease_file)
+                except (OSError, ValueError):
+                    lease = {}
+                now = time.time()
+                if lease.get("owner") not in (None, owner) and lease.get("expires", 0) > now:
+                    return False
+                with open(self._lease_path, "w", encoding="utf-8") as lease_file:
+                    json.dump({"owner": owner, "expires": now + ttl_s}, lease_file)
+                return True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def publish(self, payload):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".snapshot-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(payload)
+            os.replace(tmp_path, self._data_path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def read(self, since=None):
+        """Return (version, payload); payload is None if nothing newer than since."""
+        try:
+            stat = os.stat(self._data_path)
+        except FileNotFoundError:
+            return since, None
+        # Every publish replaces the file, so the inode identifies the version.
+        version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if version == since or stat.st_size == 0:
+            return since, None
+        with open(self._data_path, "rb") as data_file:
+            with mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return version, mapped[:]
+
+
+class RedisStore:
+    """Snapshot and lease kept in a Redis-compatible server."""
+
+    _RENEW = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end"
+    )
+
+    def __init__(self, url, prefix="mta-gtfs"):
+        if redis is None:
+            raise RuntimeError("SHARED_STORE=redis:// needs the redis package")
+        self._client = redis.Redis.from_url(url)
+        self._lease_key = f"{prefix}:lease"
+        self._data_key = f"{prefix}:snapshot"
+        self._version_key = f"{prefix}:version"
+        self._renew = self._client.register_script(self._RENEW)
+
+    def hold_lease(self, owner, ttl_s):
+        ttl_ms = int(ttl_s * 1000)
+        if self._client.set(self._lease_key, owner, nx=True, px=ttl_ms):
+            return True
+        return bool(self._renew(keys=[self._lease_key], args=[owner, ttl_ms]))
+
+    def publish(self, payload):
+        pipe = self._client.pipeline(transaction=True)
+        pipe.set(self._data_key, payload)
+        pipe.incr(self._version_key)
+        pipe.execute()
+
+    def read(self, since=None):
+        version = self._client.get(self._version_key)
+        if version is None or version == since:
+            return since, None
+        pipe = self._client.pipeline(transaction=True)
+        pipe.get(self._version_key)
+        pipe.get(self._data_key)
+        version, payload = pipe.execute()
+        return version, payload
+
+
+def open_store(spec=None):
+    """Return the store described by spec (default SHARED_STORE), or None."""
+    spec = SHARED_STORE if spec is None else spec
+    if not spec:
+        return None
+    parts = urlsplit(spec)
+    if parts.scheme == "file":
+        return FileStore(parts.path)
+    if parts.scheme in ("redis", "rediss", "unix"):
+        return RedisStore(spec)
+    raise ValueError(f"unsupported SHARED_STORE: {spec}")
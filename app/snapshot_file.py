@@ -0,0 +1,118 @@
+# On-disk copy of the last good snapshot, so a restarted process can serve
+# (stale) data before its first upstream fetch completes.
+#
+# The file is a JSON header followed by the raw feed and alerts protobuf
+# bytes it lists. Nothing in it is executable: reading one only parses JSON
+# and protobuf, and the arrival indexes are rebuilt from the raw bytes when
+# the record is installed. Writes go to a temporary file in the same
+# directory followed by os.replace, so readers never see a partial file.
+import json
+import logging
+import os
+import struct
+import tempfile
+from datetime import datetime
+
+DEFAULT_SNAPSHOT_PATH = os.path.join(
+    os.getenv("XDG_CACHE_HOME") or tempfile.gettempdir(), "mta-gtfs-server", "snapshot.bin"
+)
+# Set SNAPSHOT_PATH to an empty string to disable persistence.
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", DEFAULT_SNAPSHOT_PATH)
+FORMAT_VERSION = 4
+
+MAGIC = b"MTASNAP\n"
+_HEADER_SIZE = struct.Struct(">I")
+
+logger = logging.getLogger(__name__)
+
+
+def encode(state):
+    """Serialize state (refreshed_at, raw, alerts, sources) with the format version."""
+    blobs = [("raw", feed_id, content) for feed_id, content in state["raw"].items()]
+    if state.get("alerts") is not None:
+        blobs.append(("alerts", None, state["alerts"]))
+    header = json.dumps({
+        "version": FORMAT_VERSION,
+        "saved_at": datetime.now().isoformat(),
+        "refreshed_at": state["refreshed_at"].isoformat(),
+        "sources": state.get("sources", {}),
+        "blobs": [[kind, name, len(content)] for kind, name, content in blobs],
+    }).encode("utf-8")
+    return b"".join([MAGIC, _HEADER_SIZE.pack(len(header)), header, *(blob[2] for blob in blobs)])
+
+
+def _decode(payload):
+    if not payload.startswith(MAGIC):
+        raise ValueError("not a snapshot file")
+    offset = len(MAGIC)
+    (header_size,) = _HEADER_SIZE.unpack_from(payload, offset)
+    offset += _HEADER_SIZE.size
+    header = json.loads(payload[offset:offset + header_size])
+    offset += header_size
+    if header.get("version") != FORMAT_VERSION:
+        return None
+
+    raw = {}
+    alerts = None
+    for kind, name, size in header["blobs"]:
+        content = bytes(payload[offset:offset + size])
+        if len(content) != size:
+            raise ValueError("truncated snapshot file")
+        offset += size
+        if kind == "raw":
+            raw[name] = content
+        elif kind == "alerts":
+            alerts = content
+    return {
+        "version": header["version"],
+        "refreshed_at": datetime.fromisoformat(header["refreshed_at"]),
+        "raw": raw,
+        "alerts": alerts,
+        "sources": header.get("sources", {}),
+    }
+
+
+def decode(payload):
+    """Return the state dict encoded in payload, or None if it is not usable."""
+    try:
+        return _decode(payload)
+    except Exception:
+        logger.warning("ignoring unreadable snapshot", exc_info=True)
+        return None
+
+
+def save(state, path=None):
+    """Atomically write state to path."""
+    path = SNAPSHOT_PATH if path is None else path
+    if not path:
+        return False
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    payload = encode(state)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".snapshot-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(payload)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    return True
+
+
+def load(path=None):
+    """Return the saved state dict, or None if there is no usable file."""
+    path = SNAPSHOT_PATH if path is None else path
+    if not path:
+        return None
+    try:
+        with open(path, "rb") as snapshot_file:
+            payload = snapshot_file.read()
+    except FileNotFoundError:
+        return None
+    return decode(payload)
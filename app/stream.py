@@ -0,0 +1,78 @@
+# Server-Sent Events for /next_trains/stream.
+#
+# Each client gets a new event only when its encoded payload changes: the
+# stream wakes on every published snapshot (and every STREAM_RECHECK_S, since
+# minutes_until moves with the clock) and compares ETags. Events are always
+# rendered from the latest snapshot, so a slow client skips intermediate
+# updates instead of queueing them.
+#
+# Every open stream holds a request thread, so the client cap defaults to
+# half the server's threads (SERVER_THREADS, the value passed to gunicorn
+# --threads); the other half keeps serving /next_trains, /health and
+# /metrics however many clients stream.
+import os
+import threading
+from datetime import datetime
+
+from app import refresher
+
+SERVER_THREADS = int(os.getenv("SERVER_THREADS", "64"))
+STREAM_MAX_CLIENTS = int(os.getenv("STREAM_MAX_CLIENTS", str(max(SERVER_THREADS // 2, 1))))
+STREAM_RECHECK_S = float(os.getenv("STREAM_RECHECK_S", "15"))
+STREAM_MAX_AGE_S = float(os.getenv("STREAM_MAX_AGE_S", "3600"))
+
+_CLIENT_SLOTS = threading.BoundedSemaphore(STREAM_MAX_CLIENTS)
+_CLIENTS_LOCK = threading.Lock()
+_CLIENT_COUNT = 0
+
+
+def acquire_slot():
+    """Reserve a stream slot; returns False when the client cap is reached."""
+    global _CLIENT_COUNT
+
+    if not _CLIENT_SLOTS.acquire(blocking=False):
+        return False
+    with _CLIENTS_LOCK:
+        _CLIENT_COUNT += 1
+    return True
+
+
+def release_slot():
+    global _CLIENT_COUNT
+
+    with _CLIENTS_LOCK:
+        _CLIENT_COUNT -= 1
+    _CLIENT_SLOTS.release()
+
+
+def client_count():
+    return _CLIENT_COUNT
+
+
+def format_event(etag, body, event="next_trains"):
+    return b"".join((
+        f"id: {etag}\nevent: {event}\n".encode("utf-8"),
+        b"data: ",
+        body,
+        b"\n\n",
+    ))
+
+
+def event_stream(render, last_event_id=None, clock=datetime.now):
+    """Yield SSE frames; render(snapshot, now) returns (etag, body)."""
+    last_etag = last_event_id
+    opened_at = clock()
+    yield b"retry: 5000\n\n"
+    snapshot = refresher.get_snapshot()
+    while True:
+        now = clock()
+        if snapshot.refreshed_at is not None:
+            etag, body = render(snapshot, now)
+            if etag != last_etag:
+                last_etag = etag
+                yield format_event(etag, body)
+            else:
+                yield b": keepalive\n\n"
+        if (now - opened_at).total_seconds() >= STREAM_MAX_AGE_S:
+            return
+        snapshot = refresher.wait_for_update(snapshot.generation, STREAM_RECHECK_S)
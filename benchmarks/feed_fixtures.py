@@ -0,0 +1,198 @@
+# GTFS-realtime fixtures for benchmarks and offline tests.
+#
+# Recorded snapshots (see record_fixtures.py) are used when present under
+# benchmarks/fixtures/recorded/. Otherwise synthetic feeds are generated
+# deterministically: NYCT-shaped trip feeds (real shape ids and stop ids
+# from the static GTFS bundled with nyct_gtfs) and a camsys-shaped alerts
+# feed. `scale` multiplies trips and alerts, e.g. scale=10 for a feed ten
+# times the size of a busy weekday one.
+import csv
+import os
+import random
+import time
+
+import nyct_gtfs
+from nyct_gtfs.compiled_gtfs import gtfs_realtime_pb2, nyct_subway_pb2
+
+from app.config import FEED_LINES
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+RECORDED_DIR = os.path.join(FIXTURES_DIR, "recorded")
+ALERTS_FIXTURE = "alerts"
+
+_STATIC_DIR = os.path.join(os.path.dirname(nyct_gtfs.__file__), "gtfs_static")
+
+# Station id prefixes each route's synthetic trips are drawn from.
+ROUTE_STOP_PREFIXES = {
+    "1": "1", "2": "2", "3": "23", "4": "4", "5": "45", "6": "6", "6X": "6",
+    "7": "7", "7X": "7", "GS": "9", "S": "9",
+    "A": "A", "C": "A", "E": "AF", "H": "H", "FS": "S", "SR": "H",
+    "B": "D", "D": "D", "F": "F", "FX": "F", "M": "M", "SF": "S",
+    "G": "G", "J": "J", "Z": "J", "L": "L",
+    "N": "R", "Q": "QRD", "R": "R", "W": "R",
+    "SI": "S", "SIR": "S",
+}
+TRIPS_PER_ROUTE = 40
+STOPS_PER_ROUTE = 40
+
+ALERT_TEMPLATES = (
+    "{route} trains are running with delays while we address a signal problem",
+    "Planned work: {route} trains skip several stations in both directions",
+    "Service change: some {route} trains are rerouted via another line",
+    "{route} trains are running with some delays after a medical emergency",
+    "Elevator outage at a {route} station; use nearby stations for access",
+    "Weekend track work on the {route} line; allow extra travel time",
+)
+
+
+def _load_static():
+    stations = {}
+    with open(os.path.join(_STATIC_DIR, "stops.txt"), encoding="utf-8") as stops_file:
+        for row in csv.DictReader(stops_file):
+            if row["location_type"] == "1":
+                stations.setdefault(row["stop_id"][0], []).append(row["stop_id"])
+    shapes = {}
+    with open(os.path.join(_STATIC_DIR, "trips.txt"), encoding="utf-8") as trips_file:
+        for row in csv.DictReader(trips_file):
+            shapes.setdefault(row["route_id"], set()).add(row["shape_id"])
+    return (
+        {prefix: sorted(ids) for prefix, ids in stations.items()},
+        {route: sorted(ids) for route, ids in shapes.items()},
+    )
+
+
+_STATIC = None
+
+
+def _static():
+    global _STATIC
+
+    if _STATIC is None:
+        _STATIC = _load_static()
+    return _STATIC
+
+
+def _route_pool(route, stations):
+    pool = []
+    for prefix in ROUTE_STOP_PREFIXES.get(route, route[0]):
+        pool.extend(stations.get(prefix, ()))
+    return pool[:STOPS_PER_ROUTE]
+
+
+def _shape_id(route, direction, shapes, rng):
+    candidates = [shape for shape in shapes.get(route, ()) if f"..{direction}" in shape]
+    if candidates:
+        return rng.choice(candidates)
+    return f"{route}..{direction}01R"
+
+
+def build_trip_feed(routes, now=None, scale=1, seed=0):
+    """Return a FeedMessage with NYCT trip updates for the given routes."""
+    stations, shapes = _static()
+    rng = random.Random(seed)
+    now = int(now if now is not None else time.time())
+
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "1.0"
+    feed.header.timestamp = now
+    feed.header.Extensions[nyct_subway_pb2.nyct_feed_header].nyct_subway_version = "1.0"
+
+    entity_id = 0
+    for route in routes:
+        pool = _route_pool(route, stations)
+        if not pool:
+            continue
+        for trip_number in range(TRIPS_PER_ROUTE * scale):
+            # Trips list every remaining stop up to their terminal.
+            direction = "N" if trip_number % 2 else "S"
+            stops = list(reversed(pool)) if direction == "N" else pool
+            path = stops[rng.randrange(max(len(stops) // 2, 1)):]
+            shape_id = _shape_id(route, direction, shapes, rng)
+
+            entity_id += 1
+            entity = feed.entity.add()
+            entity.id = str(entity_id)
+            trip = entity.trip_update.trip
+            trip.trip_id = f"{rng.randrange(144000):06d}_{shape_id}"
+            trip.route_id = route
+            trip.start_date = time.strftime("%Y%m%d", time.localtime(now))
+            descriptor = trip.Extensions[nyct_subway_pb2.nyct_trip_descriptor]
+            descriptor.train_id = f"0{route} {trip_number:04d}+ SYN/TST"
+            descriptor.is_assigned = True
+
+            arrival = now + rng.randrange(-300, 3600)
+            for stop_id in path:
+                update = entity.trip_update.stop_time_update.add()
+                update.stop_id = stop_id + direction
+                update.arrival.time = arrival
+                update.departure.time = arrival + 30
+                arrival += rng.randrange(60, 180)
+    return feed
+
+
+def build_alerts_feed(routes, now=None, scale=1, seed=0):
+    """Return a FeedMessage with service alerts spread over the given routes."""
+    rng = random.Random(seed)
+    now = int(now if now is not None else time.time())
+    routes = list(routes)
+
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "1.0"
+    feed.header.timestamp = now
+    for alert_number in range(len(routes) * 8 * scale):
+        route = rng.choice(routes)
+        entity = feed.entity.add()
+        entity.id = f"lmm:alert:{alert_number}"
+        alert = entity.alert
+        for informed_route in {route, rng.choice(routes)}:
+            alert.informed_entity.add().route_id = informed_route
+        header = rng.choice(ALERT_TEMPLATES).format(route=route)
+        alert.header_text.translation.add(text=header, language="en")
+        alert.description_text.translation.add(
+            text="See the MTA website for alternative routes and travel times.", language="en"
+        )
+        period = alert.active_period.add()
+        period.start = now + rng.randrange(-7 * 86400, 86400)
+        period.end = period.start + rng.randrange(3600, 3 * 86400)
+    return feed
+
+
+def recorded_fixture(name):
+    path = os.path.join(RECORDED_DIR, f"{name}.pb")
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as fixture_file:
+        return fixture_file.read()
+
+
+def fixture_set(name, now=None):
+    """Return ({feed_id: raw bytes}, alerts raw bytes) for a named fixture set.
+
+    "small" covers only the feeds the default stop config needs, "full" every
+    NYCT feed, "10x" every feed at ten times the size, and "recorded" the
+    snapshots saved by record_fixtures.py.
+    """
+    if name == "recorded":
+        feeds = {}
+        for feed_id in FEED_LINES:
+            raw = recorded_fixture(feed_id)
+            if raw is not None:
+                feeds[feed_id] = raw
+        return feeds, recorded_fixture(ALERTS_FIXTURE)
+
+    if name == "small":
+        feed_ids, scale = ("gtfs-nqrw", "gtfs"), 1
+    elif name == "full":
+        feed_ids, scale = tuple(FEED_LINES), 1
+    elif name == "10x":
+        feed_ids, scale = tuple(FEED_LINES), 10
+    else:
+        raise ValueError(f"Unknown fixture set: {name}")
+
+    feeds = {
+        feed_id: build_trip_feed(FEED_LINES[feed_id], now, scale, seed=index).SerializeToString()
+        for index, feed_id in enumerate(feed_ids)
+    }
+    routes = [route for feed_id in feed_ids for route in FEED_LINES[feed_id]]
+    alerts = build_alerts_feed(routes, now, scale).SerializeToString()
+    return feeds, alerts
@@ -0,0 +1,41 @@
+# Record live GTFS-realtime snapshots for the "recorded" benchmark fixture set.
+#
+# Usage:
+#   python -m benchmarks.record_fixtures
+#
+# Writes one <feed_id>.pb per NYCT feed plus alerts.pb to
+# benchmarks/fixtures/recorded/. Needs network access to the MTA endpoints.
+import os
+import sys
+
+import requests
+
+from app.alerts import MTA_ALERTS_URL
+from app.config import FEED_LINES, feed_url
+from benchmarks.feed_fixtures import ALERTS_FIXTURE, RECORDED_DIR
+
+
+def record(feed_ids=tuple(FEED_LINES), timeout=10):
+    os.makedirs(RECORDED_DIR, exist_ok=True)
+    targets = [(feed_id, feed_url(feed_id)) for feed_id in feed_ids]
+    targets.append((ALERTS_FIXTURE, MTA_ALERTS_URL))
+    written = []
+    for name, url in targets:
+        response = requests.get(url, timeout=timeout)
+        response.raise_for_status()
+        path = os.path.join(RECORDED_DIR, f"{name}.pb")
+        with open(path + ".tmp", "wb") as fixture_file:
+            fixture_file.write(response.content)
+        os.replace(path + ".tmp", path)
+        written.append((path, len(response.content)))
+    return written
+
+
+def main():
+    for path, size in record():
+        sys.stdout.write(f"{path}: {size} bytes\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
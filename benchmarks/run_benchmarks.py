@@ -0,0 +1,261 @@
+"""Benchmarks for the arrivals and alerts hot paths.
+
+Usage:
+  python -m benchmarks.run_benchmarks --output bench.json
+  python -m benchmarks.run_benchmarks --fixtures small,full --min-time 0.2
+
+Results are written as JSON so runs from different releases can be diffed.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from types import SimpleNamespace
+
+from nyct_gtfs import NYCTFeed
+from nyct_gtfs.compiled_gtfs import gtfs_realtime_pb2
+
+from app import alerts, config, create_app, refresher, routes
+from app.arrivals import build_arrival_index
+from app.feed_decoder import TripFeed
+from benchmarks.feed_fixtures import fixture_set
+
+FIXTURE_SETS = ("small", "full", "10x", "recorded")
+DEFAULT_FIXTURE_SETS = ("small", "full", "10x")
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(fn, min_time_s, min_iterations=5):
+    samples = []
+    deadline = time.perf_counter() + min_time_s
+    while len(samples) < min_iterations or time.perf_counter() < deadline:
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    total = sum(samples)
+    return {
+        "iterations": len(samples),
+        "mean_us": round(total / len(samples) * 1e6, 2),
+        "p50_us": round(samples[len(samples) // 2] * 1e6, 2),
+        "p95_us": round(samples[min(int(len(samples) * 0.95), len(samples) - 1)] * 1e6, 2),
+        "max_us": round(samples[-1] * 1e6, 2),
+        "ops_per_s": round(len(samples) / total, 2) if total else None,
+    }
+
+
+def load_fixture(name, now):
+    feeds_raw, alerts_raw = fixture_set(name, now.timestamp())
+    feeds = {}
+    arrivals = {}
+    boards = {}
+    for feed_id, raw in feeds_raw.items():
+        feed = NYCTFeed(config.feed_url(feed_id), fetch_immediately=False)
+        feed.load_gtfs_bytes(raw)
+        feeds[feed_id] = feed
+        arrivals[feed_id] = build_arrival_index(feed.trips)
+        for stop_id, line in arrivals[feed_id]:
+            boards[f"{feed_id}:{stop_id}:{line}"] = {"line": line, "stop_id": stop_id}
+
+    alerts_feed = None
+    if alerts_raw is not None:
+        alerts_feed = gtfs_realtime_pb2.FeedMessage()
+        alerts_feed.ParseFromString(alerts_raw)
+
+    registry = config.build_registry({"boards": boards})
+    snapshot = refresher.EMPTY_SNAPSHOT._replace(
+        generation=1,
+        arrivals=arrivals,
+        alerts=alerts_feed,
+        status=alerts.compute_status_from_alerts(alerts_feed, registry.line_ids),
+        refreshed_at=now,
+    )
+    return SimpleNamespace(
+        feeds_raw=feeds_raw,
+        alerts_raw=alerts_raw,
+        feeds=feeds,
+        alerts_feed=alerts_feed,
+        registry=registry,
+        snapshot=snapshot,
+    )
+
+
+@contextmanager
+def use_registry(registry):
+    saved = (config.REGISTRY, config.BOARDS, routes.BOARDS)
+    config.REGISTRY = registry
+    config.BOARDS = registry.boards
+    routes.BOARDS = registry.boards
+    try:
+        yield
+    finally:
+        config.REGISTRY, config.BOARDS, routes.BOARDS = saved
+
+
+def bench_fixture(name, min_time_s):
+    now = datetime.now()
+    fixture = load_fixture(name, now)
+    if not fixture.feeds_raw:
+        return None
+
+    registry = fixture.registry
+    snapshot = fixture.snapshot
+    lines = registry.line_ids
+    boards = list(registry.boards.values())
+    results = {}
+
+    def parse_trip_feeds():
+        for feed_id, raw in fixture.feeds_raw.items():
+            fixture.feeds[feed_id].load_gtfs_bytes(raw)
+
+    def index_trip_feeds():
+        for feed in fixture.feeds.values():
+            build_arrival_index(feed.trips)
+
+    # Decode only the stops the fixture's boards use, as the refresher does
+    # for the configured boards.
+    configured_stop_ids = {board.stop_id for board in registry.boards.values()}
+    trip_feeds = {feed_id: TripFeed(configured_stop_ids) for feed_id in fixture.feeds_raw}
+
+    def decode_configured_stops():
+        for feed_id, raw in fixture.feeds_raw.items():
+            feed = trip_feeds[feed_id]
+            feed.load_gtfs_bytes(raw)
+            build_arrival_index(feed.trips)
+
+    results["parse_trip_feeds"] = measure(parse_trip_feeds, min_time_s)
+    results["build_arrival_index"] = measure(index_trip_feeds, min_time_s)
+    results["decode_configured_stops"] = measure(decode_configured_stops, min_time_s)
+
+    # The two halves of an uncached /next_trains body: slicing every board's
+    # arrivals, then joining the encoded windows, status and meta.
+    with use_registry(registry):
+        keys = tuple(registry.boards)
+        limits = (routes.NUM_TRAINS,) * len(keys)
+        results["board_windows"] = measure(
+            lambda: routes._board_windows(snapshot, now, keys, limits), min_time_s
+        )
+
+        def encoded_response_uncached():
+            routes._RESPONSE_CACHE.clear()
+            routes.get_encoded_response(snapshot, now)
+
+        results["encoded_response"] = measure(encoded_response_uncached, min_time_s)
+        routes._RESPONSE_CACHE.clear()
+
+    if fixture.alerts_feed is not None:
+        alerts_feed = fixture.alerts_feed
+
+        results["compute_status_from_alerts"] = measure(
+            lambda: alerts.compute_status_from_alerts(alerts_feed, lines), min_time_s
+        )
+        results["compute_network_status"] = measure(
+            lambda: alerts.compute_status_from_alerts(alerts_feed), min_time_s
+        )
+        results["build_status_timeline"] = measure(
+            lambda: alerts.AlertStatusCache().update_timeline(alerts_feed), min_time_s
+        )
+        timeline = alerts.AlertStatusCache().update_timeline(alerts_feed)
+        now_ts = now.timestamp()
+
+        # Alternate between the feed and a copy with one alert's period
+        # changed, so every update re-sweeps only that alert's lines.
+        changed_feed = gtfs_realtime_pb2.FeedMessage()
+        changed_feed.CopyFrom(alerts_feed)
+        if changed_feed.entity:
+            changed_feed.entity[0].alert.active_period.add().start = int(now_ts) + 60
+        status_cache = alerts.AlertStatusCache()
+        feeds = itertools.cycle((alerts_feed, changed_feed))
+        results["update_status_timeline"] = measure(
+            lambda: status_cache.update_timeline(next(feeds)), min_time_s
+        )
+        results["status_timeline_lookup"] = measure(lambda: timeline.at(now_ts), min_time_s)
+
+    app = create_app(start_refresher=False)
+    app.config["TESTING"] = True
+    saved_snapshot = refresher.get_snapshot()
+    refresher.install(snapshot)
+    try:
+        with use_registry(registry), app.test_client() as client:
+            def next_trains_uncached():
+                routes._RESPONSE_CACHE.clear()
+                client.get("/next_trains")
+
+            results["next_trains_uncached"] = measure(next_trains_uncached, min_time_s)
+            client.get("/next_trains")
+            results["next_trains_cached"] = measure(lambda: client.get("/next_trains"), min_time_s)
+    finally:
+        routes._RESPONSE_CACHE.clear()
+        refresher.install(saved_snapshot)
+
+    return {
+        "feeds": len(fixture.feeds_raw),
+        "feed_bytes": sum(len(raw) for raw in fixture.feeds_raw.values()),
+        "alerts_bytes": len(fixture.alerts_raw or b""),
+        "alert_entities": len(fixture.alerts_feed.entity) if fixture.alerts_feed is not None else 0,
+        "boards": len(boards),
+        "benchmarks": results,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def run_benchmarks(fixture_sets=DEFAULT_FIXTURE_SETS, min_time_s=0.5):
+    results = {}
+    for name in fixture_sets:
+        result = bench_fixture(name, min_time_s)
+        if result is not None:
+            results[name] = result
+    return {
+        "meta": {
+            "generated_at": datetime.now().isoformat(timespec="seconds"),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "min_time_s": min_time_s,
+        },
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--fixtures", default=",".join(DEFAULT_FIXTURE_SETS),
+                        help=f"comma-separated fixture sets: {', '.join(FIXTURE_SETS)}")
+    parser.add_argument("--min-time", type=float, default=0.5,
+                        help="minimum seconds spent on each benchmark")
+    parser.add_argument("--output", help="write JSON results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    fixture_sets = [name.strip() for name in args.fixtures.split(",") if name.strip()]
+    unknown = [name for name in fixture_sets if name not in FIXTURE_SETS]
+    if unknown:
+        parser.error(f"unknown fixture sets: {', '.join(unknown)}")
+
+    report = run_benchmarks(fixture_sets, args.min_time)
+    encoded = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(encoded + "\n")
+    else:
+        sys.stdout.write(encoded + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,13 @@
+import os
+
 from app import create_app
 
-app = create_app()
+DEBUG = os.getenv("FLASK_DEBUG", "0") == "1"
+
+# In debug mode the reloader imports this module in a watcher process and
+# again in the serving child (WERKZEUG_RUN_MAIN=true); only the child should
+# run a refresher, or every feed is fetched twice.
+app = create_app(start_refresher=not DEBUG or os.getenv("WERKZEUG_RUN_MAIN") == "true")
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0')
+    app.run(debug=DEBUG, host='0.0.0.0', threaded=True)
@@ -0,0 +1,60 @@
+import sys
+import os
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+from nyct_gtfs.compiled_gtfs import gtfs_realtime_pb2
+
+from app import alerts, config, create_app, refresher, routes
+from app.arrivals import StopArrivals
+from app.refresher import EMPTY_SNAPSHOT
+from benchmarks.feed_fixtures import fixture_set
+
+@pytest.fixture
+def client(monkeypatch):
+    # Serve synthetic feeds so the tests never touch the live MTA endpoints.
+    feeds_raw, alerts_raw = fixture_set("small")
+    alerts_feed = gtfs_realtime_pb2.FeedMessage()
+    alerts_feed.ParseFromString(alerts_raw)
+    monkeypatch.setattr(refresher, "_fetch_feed_bytes", lambda feed_id: feeds_raw[feed_id])
+    monkeypatch.setattr(alerts, "fetch_alerts_feed", lambda url: alerts_feed)
+    # Generations restart after reset(), so bodies cached by earlier tests could match.
+    monkeypatch.setattr(routes, "_RESPONSE_CACHE", {})
+    monkeypatch.setattr(routes, "_BOARDS_CACHE", {})
+    refresher.reset()
+    refresher.refresh_due(force=True)
+
+    app = create_app(start_refresher=False)
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        yield client
+    refresher.reset()
+
+@pytest.fixture
+def make_snapshot():
+    # Two southbound Q trains at Q03S, 30 and 45 minutes out.
+    def make(generation=1):
+        now = datetime.now()
+        epochs = tuple((now + timedelta(minutes=minutes)).timestamp() for minutes in (30.5, 45.5))
+        trains = (("Coney Island", "S"), ("Coney Island", "S"))
+        return EMPTY_SNAPSHOT._replace(
+            generation=generation,
+            arrivals={"gtfs-nqrw": {("Q03S", "Q"): StopArrivals(epochs=epochs, trains=trains)}},
+            status={"Q": {"badge": "OT"}, "6": {"badge": "OT"}},
+            refreshed_at=now,
+        )
+    return make
+
+@pytest.fixture
+def registry():
+    # Two boards sharing a stop on different lines, across two feeds.
+    return config.build_registry({
+        "boards": {
+            "Q_S": {"line": "Q", "stop_id": "Q03S"},
+            "N_TSQ": {"line": "N", "stop_id": "R16S"},
+            "R_TSQ": {"line": "R", "stop_id": "R16S"},
+            "6_N": {"line": "6", "stop_id": "627N"},
+        }
+    })
@@ -1,12 +1,16 @@
 import sys
 import os
-from datetime import datetime, timedelta
+import math
+from types import SimpleNamespace
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+import pytest
 from nyct_gtfs.compiled_gtfs import gtfs_realtime_pb2
 
-from app import alerts
+from app import alerts, refresher
+from app.breaker import CircuitOpenError
+from app.config import ALL_LINE_IDS
 
 def _make_alert(route_id, header_text):
     feed = gtfs_realtime_pb2.FeedMessage()
@@ -34,15 +38,173 @@ def test_compute_status_service_change():
     status = alerts.compute_status_from_alerts(feed)
     assert status["Q"]["badge"] == "CHG"
 
-def test_alerts_cache_used_on_fetch_failure(monkeypatch):
-    cached_feed = _make_alert("Q", "Q trains are delayed")
-    monkeypatch.setattr(alerts, "CACHED_ALERTS", cached_feed)
-    monkeypatch.setattr(alerts, "LAST_ALERTS_REFRESH", datetime.now() - timedelta(seconds=999))
-    monkeypatch.setattr(alerts, "ALERTS_TTL_S", 0)
+def test_alerts_status_kept_on_fetch_failure(monkeypatch):
+    feed = _make_alert("Q", "Q trains are delayed")
+    monkeypatch.setattr(alerts, "fetch_alerts_feed", lambda url: feed)
+    monkeypatch.setattr(refresher, "FEEDS", {})
+    refresher.reset()
+    try:
+        assert refresher.refresh_due(force=True).status["Q"]["badge"] == "DLY"
 
-    def _fail_fetch(url):
-        raise RuntimeError("fetch failed")
+        def _fail_fetch(url):
+            raise RuntimeError("fetch failed")
 
-    monkeypatch.setattr(alerts, "fetch_alerts_feed", _fail_fetch)
-    status = alerts.get_alerts_status(datetime.now())
+        monkeypatch.setattr(alerts, "fetch_alerts_feed", _fail_fetch)
+        snapshot = refresher.refresh_due(force=True)
+        assert snapshot.status["Q"]["badge"] == "DLY"
+        assert snapshot.sources["alerts"]["last_error"]
+    finally:
+        refresher.reset()
+
+def _make_feed(alerts_spec):
+    feed = gtfs_realtime_pb2.FeedMessage()
+    for entity_id, route_id, header_text in alerts_spec:
+        entity = feed.entity.add()
+        entity.id = entity_id
+        informed = entity.alert.informed_entity.add()
+        informed.route_id = route_id
+        entity.alert.header_text.translation.add(text=header_text)
+    return feed
+
+def test_status_cache_matches_full_computation():
+    feed = _make_feed([
+        ("1", "Q", "Planned work on the Q"),
+        ("2", "Q", "Q trains are delayed"),
+        ("3", "6", "Service change: 6 trains skip 77 St"),
+    ])
+    cache = alerts.AlertStatusCache()
+    assert cache.update(feed) == alerts.compute_status_from_alerts(feed)
+    assert cache.classified == 3
+
+def test_status_cache_only_classifies_changed_alerts():
+    cache = alerts.AlertStatusCache()
+    cache.update(_make_feed([
+        ("1", "Q", "Q trains are delayed"),
+        ("2", "6", "Planned work affects 6 trains"),
+    ]))
+
+    status = cache.update(_make_feed([
+        ("1", "Q", "Q trains are delayed"),
+        ("2", "6", "Service change: 6 trains rerouted"),
+    ]))
+
+    assert cache.classified == 1
+    assert cache.evicted == 0
     assert status["Q"]["badge"] == "DLY"
+    assert status["6"]["badge"] == "CHG"
+
+def test_status_cache_evicts_removed_alerts():
+    cache = alerts.AlertStatusCache()
+    cache.update(_make_feed([("1", "Q", "Q trains are delayed")]))
+
+    status = cache.update(_make_feed([]))
+
+    assert cache.evicted == 1
+    assert status["Q"] == {"badge": "OT"}
+    assert cache.update(None)["Q"] == {"badge": "UNK"}
+
+def test_trip_delay_fallback_when_alerts_unavailable():
+    trips = [
+        SimpleNamespace(route_id="Q", has_delay_alert=True),
+        SimpleNamespace(route_id="6", has_delay_alert=False),
+    ]
+    delayed = alerts.delayed_lines(trips)
+    assert delayed == {"Q"}
+
+    status = alerts.compute_status_from_alerts(None, ["Q", "6"], delayed)
+    assert status["Q"] == {"badge": "DLY", "reason": alerts.TRIP_DELAY_REASON}
+    assert status["6"] == {"badge": "UNK"}
+    assert alerts.AlertStatusCache(["Q"]).update(None, delayed)["Q"]["badge"] == "DLY"
+
+def test_status_covers_every_route_by_default():
+    status = alerts.compute_status_from_alerts(_make_alert("A", "A trains are delayed"))
+    assert set(status) == set(ALL_LINE_IDS)
+    assert status["A"]["badge"] == "DLY"
+
+def test_open_breaker_is_not_retried(monkeypatch):
+    calls = []
+
+    def _open(url, timeout):
+        calls.append(url)
+        raise CircuitOpenError("open")
+
+    monkeypatch.setattr(alerts.http_client, "fetch", _open)
+    monkeypatch.setattr(alerts.time, "sleep", lambda seconds: calls.append(seconds))
+    with pytest.raises(CircuitOpenError):
+        alerts.fetch_alerts_feed(alerts.MTA_ALERTS_URL)
+    assert len(calls) == 1
+
+def _add_period(feed, entity_index, start=None, end=None):
+    period = feed.entity[entity_index].alert.active_period.add()
+    if start is not None:
+        period.start = start
+    if end is not None:
+        period.end = end
+
+def test_inactive_alerts_do_not_affect_status():
+    feed = _make_feed([
+        ("1", "Q", "Planned work on the Q"),
+        ("2", "6", "6 trains are delayed"),
+    ])
+    _add_period(feed, 0, start=2_000, end=3_000)
+    _add_period(feed, 1, end=1_500)
+
+    assert alerts.compute_status_from_alerts(feed, ["Q", "6"], now=1_000) == {
+        "Q": {"badge": "OT"},
+        "6": {"badge": "DLY", "reason": "6 trains are delayed"},
+    }
+    assert alerts.compute_status_from_alerts(feed, ["Q", "6"], now=2_500)["Q"]["badge"] == "PLN"
+    assert alerts.compute_status_from_alerts(feed, ["Q", "6"], now=2_500)["6"]["badge"] == "OT"
+
+def test_status_timeline_matches_full_computation_at_every_instant():
+    feed = _make_feed([
+        ("1", "Q", "Planned work on the Q"),
+        ("2", "Q", "Q trains are delayed"),
+        ("3", "6", "Service change: 6 trains skip 77 St"),
+        ("4", "6", "Planned work on the 6"),
+    ])
+    _add_period(feed, 0, start=1_000, end=5_000)
+    _add_period(feed, 1, start=2_000, end=3_000)
+    _add_period(feed, 1, start=4_000)
+    _add_period(feed, 2, end=2_500)
+
+    timeline = alerts.AlertStatusCache(["Q", "6"]).update_timeline(feed)
+
+    assert timeline.boundaries == (1_000, 2_000, 2_500, 3_000, 4_000)
+    for now in range(0, 6_000, 250):
+        assert timeline.at(now) == alerts.compute_status_from_alerts(feed, ["Q", "6"], now=now)
+    assert timeline.next_change(2_200) == 2_500
+    assert timeline.next_change(4_000) == math.inf
+
+def test_status_timeline_rebuilds_only_changed_lines():
+    def _feed(spec, periods):
+        feed = _make_feed(spec)
+        for index, start, end in periods:
+            _add_period(feed, index, start=start, end=end)
+        return feed
+
+    lines = ["Q", "6", "N"]
+    cache = alerts.AlertStatusCache(lines)
+    cache.update_timeline(_feed(
+        [("1", "Q", "Planned work on the Q"), ("2", "6", "6 trains are delayed"), ("3", "N", "Planned work on the N")],
+        [(0, 1_000, 5_000), (1, 2_000, 3_000)],
+    ))
+    assert cache.rebuilt_lines == 3
+
+    changed = _feed(
+        [("1", "Q", "Q trains are delayed"), ("2", "6", "6 trains are delayed"), ("3", "N", "Planned work on the N")],
+        [(0, 1_500, 5_000), (1, 2_000, 3_000)],
+    )
+    timeline = cache.update_timeline(changed)
+    assert cache.rebuilt_lines == 1
+    fresh = alerts.AlertStatusCache(lines).update_timeline(changed)
+    assert (timeline.boundaries, timeline.statuses) == (fresh.boundaries, fresh.statuses)
+
+    reordered = _feed(
+        [("3", "N", "Planned work on the N"), ("1", "Q", "Q trains are delayed"), ("2", "6", "6 trains are delayed")],
+        [(1, 1_500, 5_000), (2, 2_000, 3_000)],
+    )
+    timeline = cache.update_timeline(reordered)
+    assert cache.rebuilt_lines == 3
+    fresh = alerts.AlertStatusCache(lines).update_timeline(reordered)
+    assert (timeline.boundaries, timeline.statuses) == (fresh.boundaries, fresh.statuses)
@@ -0,0 +1,73 @@
+import sys
+import os
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import arrivals
+
+def _make_trip(updates, headsign="Terminal", direction="S", route_id="Q"):
+    stop_time_updates = [
+        SimpleNamespace(stop_id=stop_id, arrival=arrival) for stop_id, arrival in updates
+    ]
+    return SimpleNamespace(
+        stop_time_updates=stop_time_updates, headsign_text=headsign, direction=direction,
+        route_id=route_id,
+    )
+
+def test_index_groups_and_sorts_by_stop():
+    now = datetime(2026, 1, 17, 12, 0, 0)
+    trips = [
+        _make_trip([("Q04S", now + timedelta(minutes=9)), ("Q03S", now + timedelta(minutes=10))], "A"),
+        _make_trip([("Q03S", now + timedelta(minutes=3))], "B"),
+        _make_trip([("Q03S", None)], "C"),
+    ]
+
+    index = arrivals.build_arrival_index(trips)
+
+    assert set(index) == {("Q03S", "Q"), ("Q04S", "Q")}
+    assert [train[0] for train in index["Q03S", "Q"].trains] == ["B", "A"]
+    assert list(index["Q03S", "Q"].epochs) == sorted(index["Q03S", "Q"].epochs)
+
+def test_index_separates_lines_sharing_a_stop():
+    now = datetime(2026, 1, 17, 12, 0, 0)
+    trips = [
+        _make_trip([("R16S", now + timedelta(minutes=minutes))], route, route_id=route)
+        for minutes, route in ((2, "N"), (3, "R"), (5, "N"), (7, "W"))
+    ]
+    index = arrivals.build_arrival_index(trips)
+
+    upcoming = arrivals.upcoming_arrivals(index, "R16S", "N", now, 8)
+    assert [train["destination"] for train in upcoming] == ["N", "N"]
+    assert arrivals.upcoming_arrivals(index, "R16S", "Q", now, 8) == []
+
+def test_upcoming_arrivals_skips_departed_and_limits():
+    now = datetime(2026, 1, 17, 12, 0, 0)
+    trips = [
+        _make_trip([("627N", now + timedelta(minutes=minutes))], f"T{minutes}", "N")
+        for minutes in (-2, 0, 1, 4, 6, 12)
+    ]
+    index = arrivals.build_arrival_index(trips)
+
+    upcoming = arrivals.upcoming_arrivals(index, "627N", "Q", now, 3)
+
+    assert [train["minutes_until"] for train in upcoming] == [1, 4, 6]
+    assert upcoming[0] == {"destination": "T1", "direction": "N", "minutes_until": 1}
+
+def test_upcoming_arrivals_unknown_stop():
+    assert arrivals.upcoming_arrivals({}, "Q03S", "Q", datetime.now(), 8) == []
+
+def test_window_expiry_is_next_minute_boundary():
+    now = datetime(2026, 1, 17, 12, 0, 0)
+    trips = [
+        _make_trip([("627N", now + timedelta(minutes=minutes))], f"T{minutes}", "N")
+        for minutes in (2.5, 5.25)
+    ]
+    index = arrivals.build_arrival_index(trips)
+    stop_arrivals = index["627N", "Q"]
+    window = arrivals.arrival_window(stop_arrivals, now.timestamp(), 8)
+
+    assert window[1] == (2, 5)
+    assert arrivals.window_expiry(stop_arrivals, window) == (now + timedelta(seconds=15)).timestamp()
+    assert arrivals.window_expiry(None, arrivals.EMPTY_WINDOW) == float("inf")
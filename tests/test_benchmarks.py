@@ -0,0 +1,38 @@
+import sys
+import os
+import json
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from benchmarks import run_benchmarks
+from benchmarks.feed_fixtures import build_trip_feed, fixture_set
+
+def test_synthetic_feed_covers_default_stops():
+    feed = build_trip_feed(("Q",), now=1_760_000_000)
+    stop_ids = {
+        update.stop_id
+        for entity in feed.entity
+        for update in entity.trip_update.stop_time_update
+    }
+    assert {"Q03S", "Q03N"} <= stop_ids
+
+def test_fixture_sets_are_deterministic():
+    assert fixture_set("small", now=1_760_000_000) == fixture_set("small", now=1_760_000_000)
+
+def test_benchmark_report_is_json(tmp_path):
+    output = tmp_path / "bench.json"
+    assert run_benchmarks.main(["--fixtures", "small", "--min-time", "0", "--output", str(output)]) == 0
+
+    report = json.loads(output.read_text())
+    benchmarks = report["results"]["small"]["benchmarks"]
+    for name in (
+        "decode_configured_stops",
+        "board_windows",
+        "encoded_response",
+        "compute_status_from_alerts",
+        "compute_network_status",
+        "next_trains_uncached",
+        "next_trains_cached",
+    ):
+        assert benchmarks[name]["iterations"] >= 5
+        assert benchmarks[name]["ops_per_s"] > 0
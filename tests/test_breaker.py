@@ -0,0 +1,74 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def _breaker(clock):
+    # jitter=1.0 makes the backoff exactly base * 2**n.
+    return CircuitBreaker(failure_threshold=3, base_backoff_s=5, max_backoff_s=15, clock=clock, jitter=lambda: 1.0)
+
+def test_opens_after_consecutive_failures():
+    clock = _Clock()
+    breaker = _breaker(clock)
+
+    breaker.failure()
+    breaker.failure()
+    assert breaker.allow() and breaker.state == CLOSED
+    breaker.failure()
+
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.short_circuited == 1
+    assert breaker.retry_in() == 5
+
+def test_half_open_trial_backs_off_exponentially():
+    clock = _Clock()
+    breaker = _breaker(clock)
+    for _ in range(3):
+        breaker.failure()
+
+    clock.now = 5
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    # Only one trial at a time.
+    assert not breaker.allow()
+
+    breaker.failure()
+    assert breaker.state == OPEN
+    assert breaker.retry_in() == 10
+
+    clock.now = 15
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.retry_in() == 15  # capped at max_backoff_s
+
+def test_success_closes_and_resets_backoff():
+    clock = _Clock()
+    breaker = _breaker(clock)
+    for _ in range(3):
+        breaker.failure()
+    clock.now = 5
+    assert breaker.allow()
+    breaker.success()
+
+    assert breaker.state == CLOSED
+    assert breaker.describe()["consecutive_failures"] == 0
+    breaker.failure()
+    assert breaker.state == CLOSED
+    for _ in range(2):
+        breaker.failure()
+    assert breaker.retry_in() == 5
+
+def test_jitter_spreads_backoff():
+    clock = _Clock()
+    breaker = CircuitBreaker(failure_threshold=1, base_backoff_s=10, clock=clock, jitter=lambda: 0.0)
+    breaker.failure()
+    assert breaker.retry_in() == 5
@@ -0,0 +1,27 @@
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+
+from app import config
+
+def test_shared_feed_is_listed_once(registry):
+    assert set(registry.feed_urls) == {"gtfs-nqrw", "gtfs"}
+    assert registry.boards["R_TSQ"].feed_id == "gtfs-nqrw"
+    assert registry.line_ids == ("Q", "N", "R", "6")
+
+def test_unknown_line_rejected():
+    with pytest.raises(ValueError):
+        config.build_registry({"boards": {"X_S": {"line": "X", "stop_id": "X01S"}}})
+
+def test_select_boards_by_stop_id(registry):
+    assert config.select_boards(None, registry) == ("Q_S", "N_TSQ", "R_TSQ", "6_N")
+    assert config.select_boards(["R16S", "Q03S"], registry) == ("N_TSQ", "R_TSQ", "Q_S")
+    with pytest.raises(KeyError):
+        config.select_boards(["XXXX"], registry)
+
+def test_default_config_matches_legacy_boards():
+    assert tuple(config.BOARDS) == ("Q_S", "Q_N", "6_S", "6_N")
+    assert config.LINE_IDS == ("Q", "6")
@@ -0,0 +1,47 @@
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from nyct_gtfs import NYCTFeed
+from nyct_gtfs.compiled_gtfs import nyct_subway_pb2
+
+from app import alerts
+from app.arrivals import build_arrival_index
+from app.feed_decoder import TripFeed
+from benchmarks.feed_fixtures import build_trip_feed
+
+STOP_IDS = {"Q03S", "Q03N", "R16S"}
+
+def _feed_with_delay_alert():
+    feed = build_trip_feed(("Q", "R"), now=1_760_000_000)
+    trip_update = next(entity.trip_update for entity in feed.entity if entity.trip_update.trip.route_id == "R")
+    train_id = trip_update.trip.Extensions[nyct_subway_pb2.nyct_trip_descriptor].train_id
+    entity = feed.entity.add()
+    entity.id = "alert"
+    informed = entity.alert.informed_entity.add()
+    informed.trip.Extensions[nyct_subway_pb2.nyct_trip_descriptor].train_id = train_id
+    return feed.SerializeToString()
+
+def test_selective_decode_matches_full_model():
+    raw = _feed_with_delay_alert()
+    full = NYCTFeed("Q", fetch_immediately=False)
+    full.load_gtfs_bytes(raw)
+    selective = TripFeed(STOP_IDS)
+    selective.load_gtfs_bytes(raw)
+
+    expected = {
+        key: stop_arrivals
+        for key, stop_arrivals in build_arrival_index(full.trips).items()
+        if key[0] in STOP_IDS
+    }
+    assert expected
+    assert build_arrival_index(selective.trips) == expected
+    assert alerts.delayed_lines(selective.trips) == alerts.delayed_lines(full.trips) == {"R"}
+
+def test_selective_decode_keeps_only_configured_stops():
+    feed = TripFeed({"Q03S"})
+    feed.load_gtfs_bytes(build_trip_feed(("Q",), now=1_760_000_000).SerializeToString())
+
+    assert feed.entity_count > len(feed.trips) > 0
+    assert {update.stop_id for trip in feed.trips for update in trip.stop_time_updates} == {"Q03S"}
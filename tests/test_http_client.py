@@ -0,0 +1,140 @@
+import sys
+import os
+import threading
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+import requests
+
+from app import http_client
+
+URL = "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs-nqrw"
+
+class _FakeSession:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, headers=None, timeout=None):
+        self.requests.append(dict(headers or {}))
+        return self.responses.pop(0)
+
+def _response(status_code, content=b"", headers=None):
+    return SimpleNamespace(status_code=status_code, content=content, headers=headers or {})
+
+@pytest.fixture(autouse=True)
+def _reset_client():
+    http_client.reset()
+    yield
+    http_client.reset()
+
+def test_revalidates_and_reports_not_modified(monkeypatch):
+    session = _FakeSession([
+        _response(200, b"x" * 100, {"ETag": '"abc"', "Last-Modified": "Sat, 17 Jan 2026 19:58:30 GMT"}),
+        _response(304),
+    ])
+    monkeypatch.setattr(http_client, "get_session", lambda: session)
+
+    assert http_client.fetch(URL, timeout=1) == b"x" * 100
+    assert http_client.fetch(URL, timeout=1) is http_client.NOT_MODIFIED
+
+    assert session.requests[0] == {}
+    assert session.requests[1] == {
+        "If-None-Match": '"abc"',
+        "If-Modified-Since": "Sat, 17 Jan 2026 19:58:30 GMT",
+    }
+    with http_client._METRICS_LOCK:
+        counters = http_client._METRICS["api-endpoint.mta.info"]
+    assert counters["requests"] == 2
+    assert counters["not_modified"] == 1
+    assert counters["bytes_received"] == 100
+    assert counters["bytes_saved"] == 100
+
+def test_invalidate_forces_full_download(monkeypatch):
+    session = _FakeSession([
+        _response(200, b"abc", {"ETag": '"abc"'}),
+        _response(200, b"abc", {"ETag": '"abc"'}),
+    ])
+    monkeypatch.setattr(http_client, "get_session", lambda: session)
+
+    http_client.fetch(URL, timeout=1)
+    http_client.invalidate(URL)
+    http_client.fetch(URL, timeout=1)
+
+    assert session.requests[1] == {}
+
+def test_error_status_raises(monkeypatch):
+    session = _FakeSession([_response(503)])
+    monkeypatch.setattr(http_client, "get_session", lambda: session)
+
+    with pytest.raises(RuntimeError):
+        http_client.fetch(URL, timeout=1)
+    with http_client._METRICS_LOCK:
+        assert http_client._METRICS["api-endpoint.mta.info"]["errors"] == 1
+
+def test_open_breaker_short_circuits_without_request(monkeypatch):
+    session = _FakeSession([_response(503) for _ in range(3)])
+    monkeypatch.setattr(http_client, "get_session", lambda: session)
+
+    for _ in range(3):
+        with pytest.raises(RuntimeError):
+            http_client.fetch(URL, timeout=1)
+    with pytest.raises(http_client.CircuitOpenError):
+        http_client.fetch(URL, timeout=1)
+
+    assert len(session.requests) == 3
+    assert http_client.get_breakers()[URL]["state"] == "open"
+    with http_client._METRICS_LOCK:
+        assert http_client._METRICS["api-endpoint.mta.info"]["short_circuited"] == 1
+
+def test_hedged_request_uses_first_answer(monkeypatch):
+    release = threading.Event()
+
+    class _SlowFirstSession(_FakeSession):
+        def get(self, url, headers=None, timeout=None):
+            self.requests.append(dict(headers or {}))
+            if len(self.requests) == 1:
+                release.wait(1)
+                return _response(200, b"slow")
+            return _response(200, b"fast")
+
+    session = _SlowFirstSession([])
+    monkeypatch.setattr(http_client, "get_session", lambda: session)
+
+    try:
+        assert http_client.fetch(URL, timeout=1, hedge_after_s=0.01) == b"fast"
+    finally:
+        release.set()
+    with http_client._METRICS_LOCK:
+        assert http_client._METRICS["api-endpoint.mta.info"]["hedged"] == 1
+
+def test_forked_child_drops_parent_connections_and_locks():
+    session = http_client.get_session()
+    breaker = http_client.get_breaker(URL)
+    http_client._get_hedge_executor()
+    # Locks held by other parent threads at the moment of fork().
+    http_client._SESSION_LOCK.acquire()
+    breaker._lock.acquire()
+
+    http_client._reinit_after_fork()
+
+    assert http_client._HEDGE_EXECUTOR is None
+    assert http_client.get_session() is not session
+    assert http_client.get_breaker(URL) is breaker
+    assert breaker.allow() is True
+    assert http_client.get_metrics() is not None
+
+def test_hedged_request_times_out_when_nothing_runs(monkeypatch):
+    class _StalledExecutor:
+        def submit(self, fn, *args, **kwargs):
+            return Future()
+
+    monkeypatch.setattr(http_client, "get_session", lambda: _FakeSession([]))
+    monkeypatch.setattr(http_client, "_get_hedge_executor", lambda: _StalledExecutor())
+
+    with pytest.raises(requests.Timeout):
+        http_client.fetch(URL, timeout=0.05, hedge_after_s=0.01)
+    assert http_client.get_breaker(URL).failures == 1
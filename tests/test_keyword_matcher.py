@@ -0,0 +1,43 @@
+import sys
+import os
+import json
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.helpers.keyword_matcher import KeywordMatcher, load_keywords
+from nyct_gtfs.compiled_gtfs import gtfs_realtime_pb2
+
+from app import alerts
+
+def test_finds_every_category_in_one_pass():
+    matcher = KeywordMatcher({
+        "DLY": ("delay", "delays"),
+        "CHG": ("skip", "skipping"),
+        "PLN": ("planned work",),
+    })
+    assert matcher.find("Planned work: trains SKIPPING 77 St with delays") == {"DLY", "CHG", "PLN"}
+    assert matcher.find("Good service") == set()
+    assert matcher.find("") == set()
+
+def test_matches_word_starts_only():
+    matcher = KeywordMatcher({"DLY": ("late",)})
+    assert matcher.find("Trains running later than usual") == {"DLY"}
+    assert matcher.find("Translated announcement") == set()
+
+def test_load_keywords_overrides_categories(tmp_path):
+    path = tmp_path / "keywords.json"
+    path.write_text(json.dumps({"DLY": ["sluggish"], "UNKNOWN": ["ignored"]}))
+
+    keywords = load_keywords({"DLY": ("delay",), "PLN": ("planned work",)}, str(path))
+
+    assert keywords == {"DLY": ("sluggish",), "PLN": ("planned work",)}
+
+def _alert(text):
+    alert = gtfs_realtime_pb2.Alert()
+    alert.header_text.translation.add(text=text)
+    return alert
+
+def test_alert_classifier_uses_matcher():
+    assert alerts._classify_alert(_alert("Trains are delayed"))[0] == "DLY"
+    assert alerts._classify_alert(_alert("Weekend work on the line"))[0] == "PLN"
+    assert alerts._classify_alert(_alert("Trains re-route via the bridge"))[0] == "CHG"
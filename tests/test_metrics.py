@@ -0,0 +1,66 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+
+from app import metrics
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+def test_histogram_buckets_are_cumulative():
+    metrics.observe("mta_stage_duration_seconds", 0.0002, stage="parse")
+    metrics.observe("mta_stage_duration_seconds", 0.03, stage="parse")
+    metrics.observe("mta_stage_duration_seconds", 60, stage="parse")
+
+    text = metrics.render()
+    assert '# TYPE mta_stage_duration_seconds histogram' in text
+    assert 'mta_stage_duration_seconds_bucket{stage="parse",le="0.0005"} 1' in text
+    assert 'mta_stage_duration_seconds_bucket{stage="parse",le="0.05"} 2' in text
+    assert 'mta_stage_duration_seconds_bucket{stage="parse",le="10.0"} 2' in text
+    assert 'mta_stage_duration_seconds_bucket{stage="parse",le="+Inf"} 3' in text
+    assert 'mta_stage_duration_seconds_count{stage="parse"} 3' in text
+
+def test_counters_and_gauges_render_with_labels():
+    metrics.inc("mta_responses_total", cache="hit")
+    metrics.inc("mta_responses_total", cache="hit")
+    metrics.set_gauge("mta_feed_bytes", 1234, source="gtfs")
+    metrics.set_gauge("mta_feed_bytes", 99, source="gtfs")
+
+    text = metrics.render()
+    assert '# TYPE mta_responses_total counter' in text
+    assert 'mta_responses_total{cache="hit"} 2' in text
+    assert 'mta_feed_bytes{source="gtfs"} 99' in text
+
+def test_metrics_endpoint_reports_cache_results_and_stages(client):
+    client.get('/next_trains')
+    client.get('/next_trains')
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    text = response.get_data(as_text=True)
+    assert 'mta_responses_total{cache="miss"} 1' in text
+    assert 'mta_responses_total{cache="hit"} 1' in text
+    assert 'stage="build_output"' in text
+    assert 'stage="encode"' in text
+
+def test_refresh_records_feed_sizes_and_stages(client):
+    text = metrics.render()
+    assert 'mta_feed_bytes{source="gtfs-nqrw"}' in text
+    assert 'mta_feed_entities{source="gtfs-nqrw"}' in text
+    assert 'mta_stage_duration_seconds_count{source="gtfs-nqrw",stage="parse"} 1' in text
+    assert 'stage="classify_alerts"' in text
+
+def test_profiler_is_opt_in():
+    assert metrics.start_profile(rate=0) is None
+
+    profiler = metrics.start_profile(rate=1)
+    assert profiler is not None
+    sum(range(1000))
+    report = metrics.finish_profile(profiler, "test")
+    assert "function calls" in report
@@ -0,0 +1,363 @@
+import sys
+import os
+import json
+import pickle
+import threading
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+
+from app import refresher, routes, scheduler, shared_store, snapshot_file
+
+class _FakeFeed:
+    def __init__(self, trips, fail=False):
+        self.trips = trips
+        self.fail = fail
+        self.refresh_calls = 0
+
+    def load_gtfs_bytes(self, gtfs_bytes):
+        self.refresh_calls += 1
+        if self.fail:
+            raise RuntimeError("feed down")
+
+def _make_trip(stop_id, arrival, headsign="Terminal", direction="S", route_id="Q"):
+    update = SimpleNamespace(stop_id=stop_id, arrival=arrival)
+    return SimpleNamespace(
+        stop_time_updates=[update], headsign_text=headsign, direction=direction, route_id=route_id
+    )
+
+@pytest.fixture(autouse=True)
+def _reset_refresher(monkeypatch):
+    refresher.reset()
+    monkeypatch.setattr(refresher, "_fetch_feed_bytes", lambda feed_id: b"")
+    monkeypatch.setattr(refresher, "_refresh_alerts", lambda: (None, {}))
+    yield
+    refresher.reset()
+
+def test_refresh_publishes_new_snapshot(monkeypatch):
+    arrival = datetime.now() + timedelta(minutes=5)
+    feed = _FakeFeed([_make_trip("Q03S", arrival)])
+    monkeypatch.setattr(refresher, "FEEDS", {"gtfs-nqrw": feed})
+
+    snapshot = refresher.refresh_due()
+
+    assert snapshot is refresher.get_snapshot()
+    assert snapshot.generation == 2
+    assert len(snapshot.arrivals["gtfs-nqrw"]["Q03S", "Q"].epochs) == 1
+    assert snapshot.refreshed_at is not None
+    assert snapshot.is_stale is False
+    assert snapshot.sources["gtfs-nqrw"]["last_error"] is None
+    assert snapshot.sources["gtfs-nqrw"]["last_refresh"] is not None
+    assert "duration_ms" in snapshot.sources["gtfs-nqrw"]
+    assert "alerts" in snapshot.sources
+
+def test_refresh_respects_ttl(monkeypatch):
+    feed = _FakeFeed([])
+    monkeypatch.setattr(refresher, "FEEDS", {"gtfs-nqrw": feed})
+
+    first = refresher.refresh_due()
+    second = refresher.refresh_due()
+
+    assert feed.refresh_calls == 1
+    assert second is first
+
+def test_failed_refresh_keeps_previous_trips(monkeypatch):
+    arrival = datetime.now() + timedelta(minutes=5)
+    feed = _FakeFeed([_make_trip("Q03S", arrival)])
+    monkeypatch.setattr(refresher, "FEEDS", {"gtfs-nqrw": feed})
+    first = refresher.refresh_due()
+
+    feed.fail = True
+    second = refresher.refresh_due(force=True)
+
+    assert second.generation > first.generation
+    assert second.arrivals["gtfs-nqrw"] == first.arrivals["gtfs-nqrw"]
+    assert second.is_stale is True
+    assert second.sources["gtfs-nqrw"]["last_error"] == "feed down"
+    assert second.sources["gtfs-nqrw"]["last_refresh"] == first.sources["gtfs-nqrw"]["last_refresh"]
+
+def test_slow_feed_does_not_block_others(monkeypatch):
+    release = threading.Event()
+    arrival = datetime.now() + timedelta(minutes=5)
+    fast = _FakeFeed([_make_trip("Q03S", arrival)])
+    slow = _FakeFeed([_make_trip("627S", arrival)])
+    monkeypatch.setattr(refresher, "FEEDS", {"gtfs-nqrw": fast, "gtfs": slow})
+
+    def _fetch(feed_id):
+        if feed_id == "gtfs":
+            release.wait(5)
+        return b""
+
+    monkeypatch.setattr(refresher, "_fetch_feed_bytes", _fetch)
+    refresher.refresh_due(block=False)
+
+    deadline = datetime.now() + timedelta(seconds=5)
+    while "gtfs-nqrw" not in refresher.get_snapshot().arrivals and datetime.now() < deadline:
+        threading.Event().wait(0.01)
+
+    snapshot = refresher.get_snapshot()
+    assert "gtfs-nqrw" in snapshot.arrivals
+    assert "gtfs" not in snapshot.arrivals
+
+    # A source that is still in flight is not claimed a second time.
+    assert "gtfs" not in refresher._claim_due_sources(force=True)
+    release.set()
+
+def test_encoded_response_reads_snapshot(monkeypatch):
+    now = datetime.now()
+    feed = _FakeFeed([_make_trip("Q03S", now + timedelta(minutes=7), "Coney Island")])
+    monkeypatch.setattr(refresher, "FEEDS", {"gtfs-nqrw": feed})
+    monkeypatch.setattr(routes, "_RESPONSE_CACHE", {})
+    snapshot = refresher.refresh_due()
+
+    cached, _ = routes.get_encoded_response(snapshot, now, ("Q_S",))
+
+    assert json.loads(cached.body)["Q_S"] == [
+        {"destination": "Coney Island", "direction": "S", "minutes_until": 7}
+    ]
+
+def test_not_modified_keeps_index_without_parsing(monkeypatch):
+    arrival = datetime.now() + timedelta(minutes=5)
+    feed = _FakeFeed([_make_trip("Q03S", arrival)])
+    monkeypatch.setattr(refresher, "FEEDS", {"gtfs-nqrw": feed})
+    first = refresher.refresh_due()
+
+    monkeypatch.setattr(refresher, "_fetch_feed_bytes", lambda feed_id: refresher.NOT_MODIFIED)
+    second = refresher.refresh_due(force=True)
+
+    assert feed.refresh_calls == 1
+    assert second.arrivals["gtfs-nqrw"] is first.arrivals["gtfs-nqrw"]
+    assert second.sources["gtfs-nqrw"]["not_modified"] is True
+    assert second.refreshed_at >= first.refreshed_at
+
+def test_ensure_running_restarts_after_fork(monkeypatch):
+    started = []
+    monkeypatch.setattr(refresher, "_THREAD", object())
+    monkeypatch.setattr(refresher, "_THREAD_PID", os.getpid())
+    monkeypatch.setattr(refresher, "_start_thread", lambda: started.append(True))
+
+    refresher.ensure_running()
+    assert started == []
+
+    monkeypatch.setattr(refresher, "_THREAD_PID", -1)
+    refresher.ensure_running()
+    assert started == [True]
+
+def test_failed_tick_is_logged_and_counted(monkeypatch, caplog):
+    def failing_tick():
+        refresher._STOP.set()
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(refresher, "_STOP", threading.Event())
+    monkeypatch.setattr(refresher, "_tick", failing_tick)
+    monkeypatch.setattr(refresher.metrics, "_COUNTERS", {})
+
+    refresher._run()
+    assert "refresher tick failed" in caplog.text
+    assert refresher.metrics._COUNTERS["mta_refresh_errors_total"] == {(): 1}
+
+def test_persisted_snapshot_is_restored_as_stale(monkeypatch, tmp_path):
+    path = str(tmp_path / "snapshot.bin")
+    arrival = datetime.now() + timedelta(minutes=5)
+    feed = _FakeFeed([_make_trip("Q03S", arrival)])
+    monkeypatch.setattr(refresher, "FEEDS", {"gtfs-nqrw": feed})
+    monkeypatch.setattr(refresher, "_fetch_feed_bytes", lambda feed_id: b"raw-bytes")
+    live = refresher.refresh_due()
+
+    assert refresher.persist(path) is True
+    # Unchanged data is not written again.
+    assert refresher.persist(path) is False
+
+    refresher.reset()
+    assert refresher.restore(path) is True
+    restored = refresher.get_snapshot()
+    assert restored.arrivals == live.arrivals
+    assert restored.raw == {"gtfs-nqrw": b"raw-bytes"}
+    assert restored.refreshed_at == live.refreshed_at
+    assert restored.restored is True
+    assert restored.is_stale is True
+
+    refreshed = refresher.refresh_due(force=True)
+    assert refreshed.restored is False
+    assert refreshed.is_stale is False
+
+def test_unwritable_snapshot_path_backs_off(monkeypatch, tmp_path, caplog):
+    blocker = tmp_path / "not-a-directory"
+    blocker.write_bytes(b"")
+    path = str(blocker / "snapshot.bin")
+    monkeypatch.setattr(refresher, "FEEDS", {"gtfs-nqrw": _FakeFeed([])})
+    refresher.refresh_due()
+
+    assert refresher.persist(path) is False
+    assert refresher.persist(path) is False
+    assert caplog.text.count("could not save snapshot") == 1
+
+    monkeypatch.setattr(refresher, "_PERSIST_RETRY_AT", 0.0)
+    assert refresher.persist(str(tmp_path / "snapshot.bin")) is True
+
+def test_restore_without_snapshot_file(tmp_path):
+    assert refresher.restore(str(tmp_path / "missing.bin")) is False
+    assert refresher.get_snapshot().refreshed_at is None
+
+def test_restore_rebuilds_index_from_raw_bytes(monkeypatch, tmp_path):
+    path = str(tmp_path / "snapshot.bin")
+    arrival = datetime.now() + timedelta(minutes=5)
+    feed = _FakeFeed([_make_trip("Q03S", arrival)])
+    monkeypatch.setattr(refresher, "FEEDS", {"gtfs-nqrw": feed})
+    live = refresher.refresh_due()
+    refresher.persist(path)
+
+    refresher.reset()
+    assert refresher.restore(path) is True
+    assert feed.refresh_calls == 2
+    assert refresher.get_snapshot().arrivals == live.arrivals
+
+def test_snapshot_file_of_another_format_is_ignored(monkeypatch, tmp_path):
+    path = tmp_path / "snapshot.bin"
+    path.write_bytes(b"not a snapshot")
+    assert refresher.restore(str(path)) is False
+    # Pickles from older releases are never unpickled.
+    path.write_bytes(pickle.dumps({"raw": {}}))
+    assert refresher.restore(str(path)) is False
+
+    monkeypatch.setattr(refresher, "FEEDS", {"gtfs-nqrw": _FakeFeed([])})
+    refresher.refresh_due()
+    refresher.persist(str(path))
+    refresher.reset()
+    monkeypatch.setattr(snapshot_file, "FORMAT_VERSION", snapshot_file.FORMAT_VERSION + 1)
+    assert refresher.restore(str(path)) is False
+
+def test_only_the_lease_holder_fetches_and_followers_install_its_snapshot(monkeypatch, tmp_path):
+    arrival = datetime.now() + timedelta(minutes=5)
+    feed = _FakeFeed([_make_trip("Q03S", arrival)])
+    monkeypatch.setattr(refresher, "FEEDS", {"gtfs-nqrw": feed})
+    fetches = []
+    monkeypatch.setattr(refresher, "_fetch_feed_bytes", lambda feed_id: fetches.append(feed_id) or b"")
+    monkeypatch.setattr(refresher, "persist", lambda path=None: False)
+    store = shared_store.FileStore(str(tmp_path))
+    monkeypatch.setattr(refresher, "_STORE", store)
+
+    assert store.hold_lease("other-worker", ttl_s=60) is True
+    refresher._tick()
+    assert refresher.get_role() == "follower"
+    assert fetches == []
+    assert refresher.get_snapshot().refreshed_at is None
+
+    # Play the lease holder: refresh and publish.
+    leader_snapshot = refresher.refresh_due(force=True)
+    assert refresher.publish_shared(store) is True
+    assert refresher.publish_shared(store) is False
+    assert fetches == ["gtfs-nqrw"]
+
+    refresher.reset()
+    refresher._tick()
+    follower_snapshot = refresher.get_snapshot()
+    assert refresher.get_role() == "follower"
+    assert fetches == ["gtfs-nqrw"]
+    # The follower rebuilds the index from the published raw bytes.
+    assert feed.refresh_calls == 2
+    assert follower_snapshot.arrivals == leader_snapshot.arrivals
+    assert follower_snapshot.refreshed_at == leader_snapshot.refreshed_at
+    assert follower_snapshot.restored is False
+
+def test_shared_store_never_carries_pickles(monkeypatch, tmp_path):
+    monkeypatch.setattr(refresher, "FEEDS", {"gtfs-nqrw": _FakeFeed([])})
+    store = shared_store.FileStore(str(tmp_path))
+    refresher.refresh_due(force=True)
+    refresher.publish_shared(store)
+    _, payload = store.read()
+    assert payload.startswith(snapshot_file.MAGIC)
+
+    refresher.reset()
+    store.publish(pickle.dumps({"raw": {"gtfs-nqrw": b""}}))
+    assert refresher.sync_shared(store) is False
+    assert refresher.get_snapshot().refreshed_at is None
+
+def test_trip_delays_drive_status_until_alerts_arrive(monkeypatch):
+    arrival = datetime.now() + timedelta(minutes=5)
+    trip = _make_trip("Q03S", arrival)
+    trip.route_id = "Q"
+    trip.has_delay_alert = True
+    monkeypatch.setattr(refresher, "FEEDS", {"gtfs-nqrw": _FakeFeed([trip])})
+
+    def _alerts_down():
+        raise RuntimeError("alerts down")
+
+    monkeypatch.setattr(refresher, "_refresh_alerts", _alerts_down)
+
+    snapshot = refresher.refresh_due()
+
+    assert snapshot.alerts is None
+    assert snapshot.status["Q"]["badge"] == "DLY"
+    assert snapshot.network_status["Q"]["badge"] == "DLY"
+    assert snapshot.network_status["A"]["badge"] == "UNK"
+
+def test_unchanged_header_timestamp_skips_parse(monkeypatch):
+    arrival = datetime.now() + timedelta(minutes=5)
+    feed = _FakeFeed([_make_trip("Q03S", arrival)])
+    monkeypatch.setattr(refresher, "FEEDS", {"gtfs-nqrw": feed})
+    monkeypatch.setattr(scheduler, "header_timestamp", lambda content: 1_760_000_000)
+    first = refresher.refresh_due()
+
+    second = refresher.refresh_due(force=True)
+
+    assert feed.refresh_calls == 1
+    assert second.arrivals["gtfs-nqrw"] is first.arrivals["gtfs-nqrw"]
+    assert refresher.get_schedules()["gtfs-nqrw"]["skipped_unchanged"] == 1
+
+def test_demand_resumes_idle_feed(monkeypatch):
+    feed = _FakeFeed([])
+    monkeypatch.setattr(refresher, "FEEDS", {"gtfs-nqrw": feed})
+    refresher.refresh_due()
+    schedule = refresher._SCHEDULES["gtfs-nqrw"]
+    schedule.last_demand -= schedule.idle_after_s + 1
+    schedule.next_due += 10_000
+    assert "gtfs-nqrw" not in refresher._claim_due_sources(force=False)
+
+    refresher.note_demand({"gtfs-nqrw"})
+
+    assert "gtfs-nqrw" in refresher._claim_due_sources(force=False)
+
+def test_start_does_not_wait_for_first_fetch(monkeypatch):
+    release = threading.Event()
+    arrival = datetime.now() + timedelta(minutes=5)
+    monkeypatch.setattr(snapshot_file, "SNAPSHOT_PATH", "")
+    monkeypatch.setattr(refresher, "FEEDS", {"gtfs-nqrw": _FakeFeed([_make_trip("Q03S", arrival)])})
+    monkeypatch.setattr(refresher, "_fetch_feed_bytes", lambda feed_id: release.wait(5) and b"")
+    # Restored on teardown so later tests do not restart the thread.
+    monkeypatch.setattr(refresher, "_THREAD_PID", None)
+
+    try:
+        refresher.start()
+        startup = refresher.get_startup()
+        assert startup["ready"] is False
+        assert startup["startup_ms"] is not None
+        assert startup["ready_after_ms"] is None
+
+        release.set()
+        for _ in range(50):
+            if refresher.get_startup()["ready"]:
+                break
+            refresher.wait_for_update(refresher.get_snapshot().generation, timeout=0.1)
+        assert refresher.get_startup()["ready"] is True
+        assert refresher.get_startup()["ready_after_ms"] is not None
+    finally:
+        release.set()
+        refresher.stop()
+
+def test_feeds_are_created_on_first_parse(monkeypatch):
+    monkeypatch.setattr(refresher, "FEEDS", {"gtfs-nqrw": None})
+    created = []
+
+    def _fake_trip_feed(stop_ids):
+        created.append(stop_ids)
+        return _FakeFeed([])
+
+    monkeypatch.setattr(refresher, "TripFeed", _fake_trip_feed)
+    assert created == []
+    refresher.refresh_due()
+    refresher.refresh_due(force=True)
+    assert len(created) == 1
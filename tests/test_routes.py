@@ -2,15 +2,18 @@ import sys
 import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-import pytest
-from app import create_app
+import gzip
+import json
+import threading
+from datetime import datetime, timedelta
 
-@pytest.fixture
-def client():
-    app = create_app()
-    app.config['TESTING'] = True
-    with app.test_client() as client:
-        yield client
+import brotli
+
+from app import alerts, encoding, refresher, routes
+from app.arrivals import StopArrivals, build_arrival_index, upcoming_arrivals
+from app.config import ALL_LINE_IDS
+from app.feed_decoder import TripFeed
+from benchmarks.feed_fixtures import build_trip_feed
 
 def test_next_trains_endpoint(client):
     response = client.get('/next_trains')
@@ -66,3 +69,303 @@ def test_health_endpoint(client):
     assert json_data.get("status") == "ok"
     assert "cache_age_seconds" in json_data
     assert "last_refresh" in json_data
+
+def test_next_trains_etag_revalidation(client, monkeypatch, make_snapshot):
+    monkeypatch.setattr(routes, "_RESPONSE_CACHE", {})
+    monkeypatch.setattr(refresher, "get_snapshot", lambda: make_snapshot())
+
+    first = client.get('/next_trains')
+    assert first.status_code == 200
+    assert first.headers["X-Cache"] == "miss"
+    assert first.headers["Cache-Control"] == "no-cache"
+    etag = first.headers["ETag"]
+
+    second = client.get('/next_trains')
+    assert second.headers["X-Cache"] == "hit"
+    assert second.headers["ETag"] == etag
+    assert second.data == first.data
+
+    not_modified = client.get('/next_trains', headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.data == b""
+    # A proxy that re-encodes the body weakens the tag.
+    weak = client.get('/next_trains', headers={"If-None-Match": "W/" + etag})
+    assert weak.status_code == 304
+
+def test_next_trains_etag_stable_across_identical_generations(client, monkeypatch, make_snapshot):
+    monkeypatch.setattr(routes, "_RESPONSE_CACHE", {})
+    snapshot = make_snapshot(generation=1)
+    monkeypatch.setattr(refresher, "get_snapshot", lambda: snapshot)
+    first = client.get('/next_trains')
+
+    snapshot = snapshot._replace(
+        generation=2, refreshed_at=snapshot.refreshed_at - timedelta(seconds=90)
+    )
+    second = client.get('/next_trains')
+    assert second.headers["ETag"] == first.headers["ETag"]
+    assert second.headers["X-Cache"] == "hit"
+    # The meta still describes the snapshot being served.
+    assert second.get_json()["meta"]["cache_age_s"] >= 90
+
+    snapshot = snapshot._replace(generation=3, status={"Q": {"badge": "DLY"}, "6": {"badge": "OT"}})
+    third = client.get('/next_trains')
+    assert third.headers["ETag"] != first.headers["ETag"]
+    assert third.get_json()["status"]["Q"]["badge"] == "DLY"
+
+def test_next_trains_stops_filter(client, monkeypatch, make_snapshot):
+    monkeypatch.setattr(routes, "_RESPONSE_CACHE", {})
+    monkeypatch.setattr(refresher, "get_snapshot", lambda: make_snapshot())
+
+    response = client.get('/next_trains?stops=Q03S,627N')
+    assert response.status_code == 200
+    json_data = response.get_json()
+    assert set(json_data) == {"meta", "status", "Q_S", "6_N"}
+    assert [train["minutes_until"] for train in json_data["Q_S"]] == [30, 45]
+
+    unknown = client.get('/next_trains?stops=XXXX')
+    assert unknown.status_code == 400
+
+def test_next_trains_concurrent_clients_share_snapshot(client, monkeypatch, make_snapshot):
+    monkeypatch.setattr(routes, "_RESPONSE_CACHE", {})
+    snapshot = make_snapshot()
+    monkeypatch.setattr(refresher, "get_snapshot", lambda: snapshot)
+    app = client.application
+    results = []
+
+    def _poll():
+        with app.test_client() as thread_client:
+            for _ in range(10):
+                response = thread_client.get('/next_trains')
+                results.append((response.status_code, response.headers["ETag"]))
+
+    threads = [threading.Thread(target=_poll) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 80
+    assert {status for status, _ in results} == {200}
+    assert len({etag for _, etag in results}) == 1
+
+def test_encoded_body_matches_board_output(client, monkeypatch, make_snapshot):
+    monkeypatch.setattr(routes, "_RESPONSE_CACHE", {})
+    snapshot = make_snapshot()
+    now = datetime.now()
+    cached, hit = routes.get_encoded_response(snapshot, now)
+
+    payload = json.loads(cached.body)
+    assert hit is False
+    assert list(payload) == ["meta", "status", "Q_S", "Q_N", "6_S", "6_N"]
+    assert payload["status"] == snapshot.status
+    for key, board in routes.BOARDS.items():
+        index = snapshot.arrivals.get(board.feed_id, {})
+        assert payload[key] == upcoming_arrivals(index, board.stop_id, board.line, now, routes.NUM_TRAINS)
+    assert [train["minutes_until"] for train in payload["Q_S"]] == [30, 45]
+
+def test_boards_sharing_a_stop_list_only_their_own_line(monkeypatch, registry, make_snapshot):
+    now = datetime.now()
+    message = build_trip_feed(("N", "Q", "R", "W"), now=int(now.timestamp()))
+    feed = TripFeed({"R16S"})
+    feed.load_gtfs_bytes(message.SerializeToString())
+    snapshot = make_snapshot()._replace(arrivals={"gtfs-nqrw": build_arrival_index(feed.trips)})
+    monkeypatch.setattr(routes, "BOARDS", registry.boards)
+    monkeypatch.setattr(routes, "_RESPONSE_CACHE", {})
+
+    cached, _ = routes.get_encoded_response(snapshot, now, ("N_TSQ", "R_TSQ"))
+    payload = json.loads(cached.body)
+    for key, line in (("N_TSQ", "N"), ("R_TSQ", "R")):
+        epochs = sorted(
+            update.arrival.time
+            for entity in message.entity
+            if entity.trip_update.trip.route_id == line
+            for update in entity.trip_update.stop_time_update
+            if update.stop_id == "R16S" and update.arrival.time > now.timestamp()
+        )
+        expected = [int((epoch - now.timestamp()) / 60) for epoch in epochs[:routes.NUM_TRAINS]]
+        assert expected
+        assert [train["minutes_until"] for train in payload[key]] == expected
+    assert payload["N_TSQ"] != payload["R_TSQ"]
+
+def test_status_endpoint_covers_every_route(client):
+    response = client.get('/status')
+    assert response.status_code == 200
+    payload = response.get_json()
+    assert payload["meta"]["source"] == "alerts"
+    assert set(payload["status"]) == set(ALL_LINE_IDS)
+
+    etag = response.headers["ETag"]
+    again = client.get('/status', headers={"If-None-Match": etag})
+    assert again.status_code == 304
+
+def test_next_trains_since_returns_only_changed_boards(client, monkeypatch, make_snapshot):
+    monkeypatch.setattr(routes, "_RESPONSE_CACHE", {})
+    monkeypatch.setattr(routes, "_DELTA_BASES", {})
+    snapshot = make_snapshot(generation=1)
+    monkeypatch.setattr(refresher, "get_snapshot", lambda: snapshot)
+
+    first = client.get('/next_trains')
+    etag = first.headers["ETag"]
+    assert set(first.get_json()["meta"]["versions"]) == {"Q_S", "Q_N", "6_S", "6_N"}
+
+    snapshot = snapshot._replace(generation=2, status={"Q": {"badge": "DLY"}, "6": {"badge": "OT"}})
+    delta = client.get(f'/next_trains?since={etag}')
+    payload = delta.get_json()
+    assert delta.headers["X-Delta"] == "delta"
+    assert payload["meta"]["delta"] is True
+    assert payload["status"] == {"Q": {"badge": "DLY"}}
+    assert set(payload) == {"meta", "status"}
+    full_etag = client.get('/next_trains').headers["ETag"]
+    assert delta.headers["ETag"] == full_etag[:-1] + "-since-" + etag[1:]
+    assert delta.headers["ETag"] != full_etag
+    etag = delta.headers["ETag"]
+
+    epochs = ((datetime.now() + timedelta(minutes=12.5)).timestamp(),)
+    arrivals = {"gtfs-nqrw": {("Q03S", "Q"): StopArrivals(epochs=epochs, trains=(("Coney Island", "S"),))}}
+    snapshot = snapshot._replace(generation=3, arrivals=arrivals)
+    delta = client.get(f'/next_trains?since={etag}').get_json()
+    assert delta["status"] == {}
+    assert set(delta) == {"meta", "status", "Q_S"}
+    assert [train["minutes_until"] for train in delta["Q_S"]] == [12]
+    assert list(delta["meta"]["versions"]) == ["Q_S"]
+
+def test_next_trains_since_unknown_version_resyncs(client, monkeypatch, make_snapshot):
+    monkeypatch.setattr(routes, "_RESPONSE_CACHE", {})
+    monkeypatch.setattr(refresher, "get_snapshot", lambda: make_snapshot())
+
+    response = client.get('/next_trains?since=not-a-version')
+    assert response.headers["X-Delta"] == "full"
+    assert "delta" not in response.get_json()["meta"]
+    assert "Q_S" in response.get_json()
+
+def test_encoded_response_reused_until_minutes_change(client, monkeypatch, make_snapshot):
+    monkeypatch.setattr(routes, "_RESPONSE_CACHE", {})
+    snapshot = make_snapshot()
+    now = snapshot.refreshed_at
+
+    first, hit = routes.get_encoded_response(snapshot, now)
+    assert hit is False
+    # Arrivals are 30.5 and 45.5 minutes out: nothing changes for 30 seconds.
+    assert first.valid_until == (now + timedelta(seconds=30)).timestamp()
+    same, hit = routes.get_encoded_response(snapshot, now + timedelta(seconds=20))
+    assert hit is True and same is first
+
+    later, hit = routes.get_encoded_response(snapshot, now + timedelta(seconds=40))
+    assert hit is False
+    assert json.loads(later.body)["Q_S"][0]["minutes_until"] == 29
+
+    departed, _ = routes.get_encoded_response(snapshot, now + timedelta(minutes=31))
+    assert [train["minutes_until"] for train in json.loads(departed.body)["Q_S"]] == [14]
+
+def test_next_trains_gzip_variant_compressed_once(client, monkeypatch, make_snapshot):
+    monkeypatch.setattr(routes, "_RESPONSE_CACHE", {})
+    snapshot = make_snapshot()
+    monkeypatch.setattr(refresher, "get_snapshot", lambda: snapshot)
+    monkeypatch.setattr(encoding, "MIN_COMPRESS_BYTES", 0)
+    calls = []
+    compress = encoding.COMPRESSORS["gzip"]
+    monkeypatch.setitem(encoding.COMPRESSORS, "gzip", lambda body: calls.append(body) or compress(body))
+
+    plain = client.get('/next_trains')
+    assert plain.headers["Content-Encoding"] == "identity"
+    assert plain.headers["Vary"] == "Accept-Encoding"
+
+    first = client.get('/next_trains', headers={"Accept-Encoding": "gzip, deflate"})
+    second = client.get('/next_trains', headers={"Accept-Encoding": "gzip"})
+    assert first.headers["Content-Encoding"] == "gzip"
+    assert first.headers["Vary"] == "Accept-Encoding"
+    assert gzip.decompress(first.data) == plain.data
+    assert second.data == first.data
+    assert len(calls) == 1
+
+    etag = first.headers["ETag"]
+    assert etag == plain.headers["ETag"][:-1] + '-gzip"'
+    not_modified = client.get('/next_trains', headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert not_modified.status_code == 304
+    delta = client.get(f'/next_trains?since={etag.strip(chr(34))}')
+    assert delta.headers["X-Delta"] == "delta"
+
+def test_next_trains_brotli_preferred_when_accepted(client, monkeypatch, make_snapshot):
+    monkeypatch.setattr(routes, "_RESPONSE_CACHE", {})
+    snapshot = make_snapshot()
+    monkeypatch.setattr(refresher, "get_snapshot", lambda: snapshot)
+    monkeypatch.setattr(encoding, "MIN_COMPRESS_BYTES", 0)
+
+    plain = client.get('/next_trains')
+    response = client.get('/next_trains', headers={"Accept-Encoding": "gzip, br"})
+    assert response.headers["Content-Encoding"] == "br"
+    assert response.headers["ETag"] == plain.headers["ETag"][:-1] + '-br"'
+    assert brotli.decompress(response.data) == plain.data
+
+def test_status_follows_alert_periods_between_refreshes(monkeypatch, make_snapshot):
+    monkeypatch.setattr(routes, "_RESPONSE_CACHE", {})
+    snapshot = make_snapshot()
+    now = snapshot.refreshed_at
+    starts = (now + timedelta(seconds=10)).timestamp()
+    timeline = alerts.StatusTimeline(
+        [starts],
+        [{"Q": {"badge": "OT"}, "6": {"badge": "OT"}}, {"Q": {"badge": "PLN"}, "6": {"badge": "OT"}}],
+    )
+    snapshot = snapshot._replace(**refresher._status_changes(timeline))
+
+    before, _ = routes.get_encoded_response(snapshot, now)
+    assert before.valid_until == starts
+    assert json.loads(before.body)["status"]["Q"]["badge"] == "OT"
+
+    after, hit = routes.get_encoded_response(snapshot, now + timedelta(seconds=15))
+    assert hit is False
+    assert json.loads(after.body)["status"]["Q"]["badge"] == "PLN"
+    assert routes.get_encoded_status(snapshot, starts).network_status["Q"]["badge"] == "PLN"
+
+def test_boards_batch_with_per_stop_limits(client, monkeypatch, make_snapshot):
+    snapshot = make_snapshot()
+    epochs = tuple((snapshot.refreshed_at + timedelta(minutes=minutes)).timestamp() for minutes in (5.5, 9.5, 12.5))
+    arrivals = {
+        "gtfs-nqrw": snapshot.arrivals["gtfs-nqrw"],
+        "gtfs": {("627N", "6"): StopArrivals(epochs=epochs, trains=(("Pelham Bay Park", "N"),) * 3)},
+    }
+    snapshot = snapshot._replace(arrivals=arrivals)
+    monkeypatch.setattr(refresher, "get_snapshot", lambda: snapshot)
+
+    first = client.get('/boards?stops=Q03S:1,627N&limit=2')
+    assert first.status_code == 200
+    assert first.headers["X-Cache"] == "miss"
+    payload = first.get_json()
+    assert list(payload["boards"]) == ["Q_S", "6_N"]
+    assert len(payload["boards"]["Q_S"]) == 1
+    assert [train["minutes_until"] for train in payload["boards"]["6_N"]] == [5, 9]
+    assert payload["status"] == {"Q": {"badge": "OT"}, "6": {"badge": "OT"}}
+    assert set(payload["meta"]["versions"]) == {"Q_S", "6_N"}
+
+    second = client.get('/boards?stops=Q03S:1,627N&limit=2')
+    assert second.headers["X-Cache"] == "hit"
+    assert second.data == first.data
+    assert client.get('/boards?stops=Q03S:1,627N&limit=2', headers={"If-None-Match": first.headers["ETag"]}).status_code == 304
+
+    only_q = client.get('/boards?stops=Q03S').get_json()
+    assert only_q["status"] == {"Q": {"badge": "OT"}}
+    assert len(only_q["boards"]["Q_S"]) == 2
+
+def test_boards_rejects_bad_requests(client):
+    assert client.get('/boards?stops=NOPE').status_code == 400
+    assert client.get('/boards?stops=Q03S:0').status_code == 400
+    assert client.get('/boards?stops=Q03S:abc').status_code == 400
+    assert client.get('/boards?limit=999').status_code == 400
+
+def test_boards_default_limit_is_capped(client, monkeypatch):
+    monkeypatch.setattr(routes, "NUM_TRAINS", routes.MAX_BOARD_LIMIT + 10)
+
+    response = client.get('/boards?stops=Q03S')
+    assert response.status_code == 200
+    assert routes._BOARDS_CACHE
+    assert all(limits == (routes.MAX_BOARD_LIMIT,) for _, limits in routes._BOARDS_CACHE)
+    assert client.get(f'/boards?stops=Q03S&limit={routes.MAX_BOARD_LIMIT + 1}').status_code == 400
+
+def test_boards_cache_evicts_least_recently_used(client, monkeypatch):
+    monkeypatch.setattr(routes, "BOARDS_CACHE_SIZE", 2)
+    client.get('/boards?stops=Q03S')
+    client.get('/boards?stops=627N')
+    client.get('/boards?stops=Q03S')
+    client.get('/boards?stops=627S')
+
+    assert [keys for keys, _ in routes._BOARDS_CACHE] == [("Q_S",), ("6_S",)]
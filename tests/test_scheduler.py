@@ -0,0 +1,51 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from nyct_gtfs.compiled_gtfs import gtfs_realtime_pb2
+
+from app import scheduler
+
+def _feed_bytes(timestamp):
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "1.0"
+    feed.header.timestamp = timestamp
+    entity = feed.entity.add()
+    entity.id = "1"
+    entity.trip_update.trip.trip_id = "trip"
+    return feed.SerializeToString()
+
+def test_header_timestamp_reads_only_the_header():
+    assert scheduler.header_timestamp(_feed_bytes(1_760_000_123)) == 1_760_000_123
+    assert scheduler.header_timestamp(b"") is None
+    assert scheduler.header_timestamp(b"\x0a\xff") is None
+
+def test_schedule_learns_publish_cadence_and_aligns_to_it():
+    schedule = scheduler.AdaptiveSchedule(20, clock=lambda: 0.0)
+
+    assert schedule.fetched(0.0, 1000.0, header_ts=995) is True
+    assert schedule.interval(0.0) == 20
+    assert schedule.fetched(10.0, 1010.0, header_ts=1005) is True
+    assert schedule.publish_interval_s == 10
+    # Next publish expected at 1015; fetch PUBLISH_LAG_S after it.
+    assert schedule.next_due == 10.0 + 5 + scheduler.PUBLISH_LAG_S
+
+def test_unchanged_header_is_skipped_and_retried_sooner():
+    schedule = scheduler.AdaptiveSchedule(20, clock=lambda: 0.0)
+    schedule.fetched(0.0, 1000.0, header_ts=1000)
+
+    assert schedule.fetched(20.0, 1020.0, header_ts=1000) is False
+    assert schedule.skipped == 1
+    assert schedule.next_due == 20.0 + scheduler.MIN_INTERVAL_S
+    assert schedule.fetched(30.0, 1030.0, modified=False) is False
+    assert schedule.skipped == 2
+
+def test_idle_schedule_backs_off_and_resumes_on_demand():
+    schedule = scheduler.AdaptiveSchedule(20, idle_after_s=60, clock=lambda: 0.0)
+    schedule.fetched(100.0, 1100.0)
+
+    assert schedule.is_idle(100.0)
+    assert schedule.next_due == 100.0 + scheduler.IDLE_REFRESH_S
+    schedule.note_demand(150.0)
+    assert schedule.is_due(150.0)
+    assert schedule.interval(150.0) == 20
@@ -0,0 +1,44 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+
+from app import shared_store
+
+def test_file_store_lease_is_exclusive_until_it_expires(tmp_path, monkeypatch):
+    store = shared_store.FileStore(str(tmp_path))
+    clock = [1000.0]
+    monkeypatch.setattr(shared_store.time, "time", lambda: clock[0])
+
+    assert store.hold_lease("worker-a", ttl_s=10) is True
+    assert store.hold_lease("worker-b", ttl_s=10) is False
+    # The holder renews its own lease.
+    clock[0] += 8
+    assert store.hold_lease("worker-a", ttl_s=10) is True
+    clock[0] += 8
+    assert store.hold_lease("worker-b", ttl_s=10) is False
+
+    clock[0] += 11
+    assert store.hold_lease("worker-b", ttl_s=10) is True
+    assert store.hold_lease("worker-a", ttl_s=10) is False
+
+def test_file_store_read_returns_only_new_versions(tmp_path):
+    store = shared_store.FileStore(str(tmp_path))
+    assert store.read() == (None, None)
+
+    store.publish(b"first")
+    version, payload = store.read()
+    assert payload == b"first"
+    assert store.read(version) == (version, None)
+
+    store.publish(b"second")
+    newer, payload = store.read(version)
+    assert newer != version
+    assert payload == b"second"
+
+def test_open_store_selects_backend(tmp_path):
+    assert shared_store.open_store("") is None
+    assert isinstance(shared_store.open_store(f"file://{tmp_path}"), shared_store.FileStore)
+    with pytest.raises(ValueError):
+        shared_store.open_store("ftp://example.com/store")
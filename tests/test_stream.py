@@ -0,0 +1,65 @@
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+
+from app import create_app, refresher, routes, stream
+
+@pytest.fixture
+def client():
+    app = create_app(start_refresher=False)
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        yield client
+
+def _frames(response, count):
+    frames = []
+    chunks = iter(response.response)
+    while len(frames) < count:
+        frames.append(next(chunks))
+    return frames
+
+def test_stream_pushes_only_changed_payloads(client, monkeypatch, make_snapshot):
+    snapshots = [make_snapshot(generation=1)]
+    monkeypatch.setattr(routes, "_RESPONSE_CACHE", {})
+    monkeypatch.setattr(refresher, "get_snapshot", lambda: snapshots[0])
+
+    def _wait_for_update(generation, timeout):
+        snapshot = snapshots[0]._replace(generation=generation + 1)
+        if generation == 2:
+            snapshot = snapshot._replace(status={"Q": {"badge": "DLY"}, "6": {"badge": "OT"}})
+        snapshots[0] = snapshot
+        return snapshot
+
+    monkeypatch.setattr(refresher, "wait_for_update", _wait_for_update)
+
+    response = client.get('/next_trains/stream', buffered=False)
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/event-stream")
+
+    retry, first, unchanged, changed = _frames(response, 4)
+    response.close()
+
+    assert retry.startswith(b"retry:")
+    assert first.startswith(b"id: ") and b"event: next_trains" in first
+    assert unchanged == b": keepalive\n\n"
+    assert b'"DLY"' in changed
+    assert stream.client_count() == 0
+
+def test_stream_rejects_clients_over_cap(client, monkeypatch):
+    monkeypatch.setattr(stream, "acquire_slot", lambda: False)
+
+    response = client.get('/next_trains/stream')
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "30"
+
+def test_stream_resumes_from_last_event_id(monkeypatch, make_snapshot):
+    snapshot = make_snapshot()
+    monkeypatch.setattr(refresher, "get_snapshot", lambda: snapshot)
+    events = stream.event_stream(lambda snap, now: ("abc", b"{}"), last_event_id="abc")
+
+    assert next(events).startswith(b"retry:")
+    assert next(events) == b": keepalive\n\n"